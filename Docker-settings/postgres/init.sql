@@ -49,3 +49,84 @@ CREATE TABLE IF NOT EXISTS content.person_film_work (
 CREATE UNIQUE INDEX IF NOT EXISTS film_work_genre ON genre_film_work (film_work_id, genre_id);
 
 CREATE UNIQUE INDEX IF NOT EXISTS film_work_person_role ON person_film_work (film_work_id, person_id, role);
+
+CREATE INDEX IF NOT EXISTS film_work_updated_at_id ON film_work (updated_at, id);
+
+CREATE INDEX IF NOT EXISTS person_updated_at_id ON person (updated_at, id);
+
+CREATE INDEX IF NOT EXISTS genre_updated_at_id ON genre (updated_at, id);
+
+CREATE TABLE IF NOT EXISTS content.etl_state (
+    namespace text NOT NULL,
+    key text NOT NULL,
+    value jsonb,
+    PRIMARY KEY (namespace, key)
+);
+
+-- Канал по умолчанию (app.notify_channel), при старте с change_feed ETL пересоздаёт функцию с каналом из настроек
+CREATE OR REPLACE FUNCTION content.notify_etl() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('etl_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS film_work_notify_etl ON content.film_work;
+CREATE TRIGGER film_work_notify_etl AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl();
+
+DROP TRIGGER IF EXISTS person_notify_etl ON content.person;
+CREATE TRIGGER person_notify_etl AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.person
+    FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl();
+
+DROP TRIGGER IF EXISTS genre_notify_etl ON content.genre;
+CREATE TRIGGER genre_notify_etl AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.genre
+    FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl();
+
+DROP TRIGGER IF EXISTS person_film_work_notify_etl ON content.person_film_work;
+CREATE TRIGGER person_film_work_notify_etl AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.person_film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl();
+
+DROP TRIGGER IF EXISTS genre_film_work_notify_etl ON content.genre_film_work;
+CREATE TRIGGER genre_film_work_notify_etl AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.genre_film_work
+    FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl();
+
+CREATE TABLE IF NOT EXISTS content.etl_tombstone (
+    id bigserial PRIMARY KEY,
+    table_name text NOT NULL,
+    row_id uuid NOT NULL,
+    film_work_id uuid,
+    deleted_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION content.etl_tombstone() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME IN ('person_film_work', 'genre_film_work') THEN
+        INSERT INTO content.etl_tombstone (table_name, row_id, film_work_id)
+            VALUES (TG_TABLE_NAME, OLD.id, OLD.film_work_id);
+    ELSE
+        INSERT INTO content.etl_tombstone (table_name, row_id) VALUES (TG_TABLE_NAME, OLD.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS film_work_etl_tombstone ON content.film_work;
+CREATE TRIGGER film_work_etl_tombstone AFTER DELETE ON content.film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_tombstone();
+
+DROP TRIGGER IF EXISTS person_etl_tombstone ON content.person;
+CREATE TRIGGER person_etl_tombstone AFTER DELETE ON content.person
+    FOR EACH ROW EXECUTE FUNCTION content.etl_tombstone();
+
+DROP TRIGGER IF EXISTS genre_etl_tombstone ON content.genre;
+CREATE TRIGGER genre_etl_tombstone AFTER DELETE ON content.genre
+    FOR EACH ROW EXECUTE FUNCTION content.etl_tombstone();
+
+DROP TRIGGER IF EXISTS person_film_work_etl_tombstone ON content.person_film_work;
+CREATE TRIGGER person_film_work_etl_tombstone AFTER DELETE ON content.person_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_tombstone();
+
+DROP TRIGGER IF EXISTS genre_film_work_etl_tombstone ON content.genre_film_work;
+CREATE TRIGGER genre_film_work_etl_tombstone AFTER DELETE ON content.genre_film_work
+    FOR EACH ROW EXECUTE FUNCTION content.etl_tombstone();
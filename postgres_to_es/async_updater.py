@@ -0,0 +1,228 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from elasticsearch import AsyncElasticsearch
+
+from backoff_decorator import async_backoff
+from change_feed import ChangeListener
+from config import es_config, app_config, movies_index
+from fingerprints import FingerprintStore, fingerprint
+from connectors import ESConnector, PGConnector, drop_rejected, next_sleep_time, split_bulk_response
+import metrics
+import profiling
+from logger import log
+from serializer import bulk_body, index_action
+from scheduler import PollScheduler
+from storage import flush_states
+from transform import transformer
+from updater import is_full, poll_source, poll_sources, source_checkpoint
+
+log = log.getChild(__name__)
+
+_END = object()
+# Синхронные объекты (коннекторы, State, хранилища SQLite, хеши документов) создаются и используются
+# в одном потоке: соединение SQLite нельзя использовать из потока, в котором оно не создано
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='etl-sync')
+
+
+async def in_sync_thread(f, *args):
+    """Выполнить f в потоке синхронных объектов, не блокируя цикл событий"""
+    return await asyncio.get_running_loop().run_in_executor(_sync_executor, partial(f, *args))
+
+
+class AsyncESConnector:
+    """Загрузка пачек в ES через асинхронный клиент, до es_config.inflight_bulk запросов одновременно.
+    Хеши документов пачки записываются только когда подтверждены все более ранние пачки,
+    хранилище хешей создаётся (open_storage) и используется только в потоке синхронных объектов
+    """
+
+    def __init__(self):
+        self.connection = AsyncElasticsearch(host=es_config.ES_URL)
+        self.fingerprints = None
+        self.next_seq = 0
+        self.done = {}
+
+    def open_storage(self):
+        self.fingerprints = FingerprintStore() if app_config.fingerprints else None
+
+    @async_backoff(logy=log.getChild('AsyncESConnector.bulk_request'))
+    async def bulk_request(self, block: list) -> dict:
+        return await self.connection.bulk(
+            body=bulk_body(block), index=movies_index, params={'filter_path': 'errors,items.*.status,items.*.error'}
+        )
+
+    async def load(self, block: list) -> set:
+        """Загрузить пачку в ES, повторяя с нарастающей паузой только документы с 429/503.
+        Отдаёт uuid документов, отвергнутых ES насовсем
+        """
+        t = app_config.backoff_start_sleep_time
+        rejected = set()
+        while block:
+            with metrics.timed('load'):
+                res = await self.bulk_request(block)
+            metrics.BULK_BYTES.labels(movies_index).inc(sum(len(line) for line in block))
+            retry, block_rejected = split_bulk_response(block, res, movies_index) if res.get('errors') else ([], [])
+            rejected.update(block_rejected)
+            confirmed = len(block) - len(retry) - len(block_rejected)
+            metrics.BULK_DOCS.labels(movies_index).inc(confirmed)
+            log.info(f'Add block of {confirmed} records')
+            if retry:
+                log.warning(f'Retry {len(retry)} records in {t} sec')
+                await asyncio.sleep(t)
+                t = next_sleep_time(t)
+            block = retry
+        return rejected
+
+    def filter_unchanged(self, docs: list) -> tuple:
+        """Строки пачки (uuid, строка bulk) без документов, совпадающих с уже подтверждёнными ES,
+        и хеши оставшихся документов
+        """
+        if self.fingerprints is None:
+            return [line for _, line in docs], []
+        block, block_fingerprints = [], []
+        for uuid, line in docs:
+            digest = fingerprint(line)
+            if self.fingerprints.is_unchanged(movies_index, uuid, digest):
+                metrics.DOCS_SKIPPED.inc()
+                continue
+            block.append(line)
+            block_fingerprints.append((uuid, digest))
+        return block, block_fingerprints
+
+    async def commit(self, seq: int, block_fingerprints: list):
+        """Отметить пачку seq подтверждённой и записать хеши пачек до последней непрерывно подтверждённой"""
+        self.done[seq] = block_fingerprints
+        ready = []
+        while self.next_seq in self.done:
+            ready.append(self.done.pop(self.next_seq))
+            self.next_seq += 1
+        if ready:
+            # Поток синхронных объектов один, поэтому пачки записываются в порядке подтверждения
+            await in_sync_thread(self._save, ready)
+
+    def _save(self, ready: list):
+        """Записать хеши непрерывно подтверждённых пачек"""
+        if self.fingerprints is None:
+            return
+        for block_fingerprints in ready:
+            self.fingerprints.save(movies_index, block_fingerprints)
+
+    async def close(self):
+        await self.connection.close()
+
+
+async def extract(pg, rows_queue: asyncio.Queue):
+    """Стадия extract: генератор PGConnector крутится в отдельном потоке, цикл событий не блокируется"""
+    films = pg.pop_next_to_update()
+    while True:
+        rows = await in_sync_thread(next, films, _END)
+        if rows is _END:
+            break
+        await rows_queue.put(rows)
+    await rows_queue.put(_END)
+
+
+async def transform(es: AsyncESConnector, rows_queue: asyncio.Queue, blocks_queue: asyncio.Queue):
+    """Стадия transform: собирает документы в пачки по es_config.bulk_factor и es_config.bulk_max_bytes,
+    неизменившиеся документы отсеиваются по хешам целой пачкой
+    """
+    docs = []
+    block_bytes = 0
+    seq = 0
+    while True:
+        rows = await rows_queue.get()
+        if rows is _END:
+            break
+        with metrics.timed('transform'):
+            doc, uuid = transformer(rows)
+        metrics.DOCS_TRANSFORMED.inc()
+        line = index_action(movies_index, doc, uuid)
+        docs.append((uuid, line))
+        block_bytes += len(line)
+        if len(docs) >= es_config.bulk_factor or block_bytes >= es_config.bulk_max_bytes:
+            block, block_fingerprints = await in_sync_thread(es.filter_unchanged, docs)
+            await blocks_queue.put((seq, block, block_fingerprints))
+            seq += 1
+            docs = []
+            block_bytes = 0
+    if docs:
+        block, block_fingerprints = await in_sync_thread(es.filter_unchanged, docs)
+        await blocks_queue.put((seq, block, block_fingerprints))
+
+
+async def load(es: AsyncESConnector, blocks_queue: asyncio.Queue):
+    """Стадия load: один из es_config.inflight_bulk обработчиков очереди пачек"""
+    while True:
+        item = await blocks_queue.get()
+        if item is _END:
+            break
+        seq, block, block_fingerprints = item
+        if block:
+            block_fingerprints = drop_rejected(block_fingerprints, await es.load(block))
+        await es.commit(seq, block_fingerprints)
+
+
+async def async_updater(pg, es: AsyncESConnector):
+    """Один проход стека pg через конвейер с ограниченными очередями между стадиями"""
+    rows_queue = asyncio.Queue(maxsize=app_config.async_queue_size * es_config.bulk_factor)
+    blocks_queue = asyncio.Queue(maxsize=app_config.async_queue_size)
+    es.next_seq = 0
+    es.done = {}
+    loaders = [asyncio.create_task(load(es, blocks_queue)) for _ in range(es_config.inflight_bulk)]
+    await asyncio.gather(extract(pg, rows_queue), transform(es, rows_queue, blocks_queue))
+    for _ in loaders:
+        await blocks_queue.put(_END)
+    await asyncio.gather(*loaders)
+
+
+async def async_never_ending_process():
+    # Синхронный клиент нужен для создания индексов, удалений и частичных обновлений update_by_query
+    sync_es = await in_sync_thread(ESConnector)
+    await in_sync_thread(sync_es.prepare_indexes)
+    pg = await in_sync_thread(PGConnector)
+    if app_config.deletions:
+        await in_sync_thread(pg.prepare_tombstones)
+    if app_config.change_feed:
+        await in_sync_thread(pg.prepare_change_feed)
+    es = AsyncESConnector()
+    await in_sync_thread(es.open_storage)
+    listener = await asyncio.to_thread(ChangeListener) if app_config.change_feed else None
+    scheduler = PollScheduler(poll_sources())
+    metrics.start()
+    profiling.install()
+    try:
+        while True:
+            with profiling.cycle():
+                polled = []
+                for source in scheduler.due():
+                    polled.append((source, await in_sync_thread(poll_source, source, pg, sync_es)))
+                if polled:
+                    await async_updater(pg, es)
+                    await in_sync_thread(pg.commit_queue)
+            for source, rows in polled:
+                checkpoint = await in_sync_thread(source_checkpoint, source, pg)
+                scheduler.record(source, rows, is_full(source, rows), checkpoint)
+
+            wait = scheduler.next_wait()
+            if not wait:
+                continue
+            await in_sync_thread(flush_states)
+            metrics.export()
+            scheduler.log_stats()
+            log.info(f'Nothing to update, now wait for {wait:.1f} sec ...')
+            if listener is not None:
+                tables = await asyncio.to_thread(listener.wait, wait)
+                if tables:
+                    log.info(f'Changes notified in: {", ".join(sorted(tables))}')
+                    scheduler.wake(tables)
+            else:
+                await asyncio.sleep(wait)
+    finally:
+        # Сброс состояний в потоке их хранилищ: при выходе (atexit) сбрасывать уже нечего
+        await in_sync_thread(flush_states)
+        await es.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(async_never_ending_process())
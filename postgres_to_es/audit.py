@@ -0,0 +1,82 @@
+import argparse
+import uuid
+
+from config import app_config, movies_index
+from connectors import ESConnector, PGConnector
+from logger import log
+from reindex import UUID_SPACE
+from updater import update
+
+log = log.getChild(__name__)
+
+
+def split_range(after: int, last: int, parts: int) -> list:
+    """Разбить диапазон uuid (after, last] на parts подряд идущих непустых диапазонов"""
+    bounds = [after + (last - after) * part // parts for part in range(parts + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(parts) if bounds[i] < bounds[i + 1]]
+
+
+def resync(pg: PGConnector, es: ESConnector, pg_ids: dict, es_ids: dict) -> tuple:
+    """Переиндексировать фильмы, которых нет в ES или у которых там другой updated_at,
+    и удалить из ES фильмы, которых нет в Postgres. Отдаёт число тех и других
+    """
+    stale = [film_id for film_id, updated_at in pg_ids.items() if es_ids.get(film_id, '') != updated_at]
+    extra = [film_id for film_id in es_ids if film_id not in pg_ids]
+    if extra:
+        es.delete_documents(es.index, extra)
+    if stale:
+        if es.fingerprints is not None:
+            es.fingerprints.forget_ids(es.index, stale)
+        pg.push_films(stale)
+        update(pg=pg, es=es)
+    return len(stale), len(extra)
+
+
+def audit(fix: bool = False, index: str = movies_index) -> dict:
+    """
+    Сверка индекса фильмов с Postgres по контрольным суммам диапазонов uuid:
+    число фильмов, сумма первых 32 бит uuid и сумма updated_at в секундах с обеих сторон.
+    Совпавший диапазон дальше не проверяется, отличающийся делится на audit_fanout частей,
+    пока в нём больше audit_leaf_size фильмов, в оставшихся сравниваются сами uuid и updated_at.
+    С fix расхождения устраняются (resync)
+    """
+    pg = PGConnector()
+    es = ESConnector()
+    es.index = index
+    result = {'queries': 0, 'ranges': 0, 'stale': 0, 'extra': 0}
+    ranges = split_range(0, UUID_SPACE - 1, app_config.audit_ranges)
+    while ranges:
+        after, last = ranges.pop()
+        after_id, last_id = str(uuid.UUID(int=after)), str(uuid.UUID(int=last))
+        pg_sum = pg.range_checksum(after_id, last_id)
+        es_sum = es.range_checksum(after_id, last_id)
+        result['queries'] += 2
+        if pg_sum == es_sum:
+            continue
+        if max(pg_sum[0], es_sum[0]) > app_config.audit_leaf_size:
+            ranges.extend(split_range(after, last, app_config.audit_fanout))
+            continue
+        result['ranges'] += 1
+        pg_ids = pg.range_ids(after_id, last_id)
+        es_ids = es.range_ids(after_id, last_id)
+        log.warning(f'Range ({after_id}, {last_id}] differs: {len(pg_ids)} films in PG, {len(es_ids)} in ES')
+        if fix:
+            stale, extra = resync(pg, es, pg_ids, es_ids)
+        else:
+            stale = sum(1 for film_id, updated_at in pg_ids.items() if es_ids.get(film_id, '') != updated_at)
+            extra = sum(1 for film_id in es_ids if film_id not in pg_ids)
+        result['stale'] += stale
+        result['extra'] += extra
+    log.info(
+        f'Audit of index:{index} finished in {result["queries"]} checksum queries: '
+        f'{result["ranges"]} ranges differ, {result["stale"]} stale or missing and {result["extra"]} extra films'
+        f'{" fixed" if fix else ""}'
+    )
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сверка индекса фильмов ES с Postgres')
+    parser.add_argument('--fix', action='store_true', help='переиндексировать и удалить расходящиеся фильмы')
+    args = parser.parse_args()
+    audit(args.fix)
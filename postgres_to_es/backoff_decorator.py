@@ -1,9 +1,11 @@
+import asyncio
 import time
 from functools import wraps
 from typing import Optional
 
 from config import app_config
 from logger import log
+from profiling import stage
 
 
 def backoff(
@@ -15,7 +17,8 @@ def backoff(
     """
         Функция для повторного выполнения функции через некоторое время, если возникла ошибка.
          Использует наивный экспоненциальный рост времени повтора (factor)
-            до граничного времени ожидания (border_sleep_time)
+            до граничного времени ожидания (border_sleep_time).
+         Первая попытка выполняется сразу, ожидание - только после ошибки
 
         Формула:
             t = start_sleep_time * 2^(n) if t < border_sleep_time
@@ -37,12 +40,13 @@ def backoff(
             counter = 1
             while True:
                 try:
-                    time.sleep(t)
                     result = f(*args, **kwargs)
                     break
 
                 except Exception:
                     logy.exception(f'Connection failed, reconnection attempt #{counter}, wait time - {t} sec')
+                    with stage('backoff.sleep'):
+                        time.sleep(t)
                     if t < border_sleep_time:
                         t = t * 2 ** factor
                     if t >= border_sleep_time:
@@ -56,5 +60,43 @@ def backoff(
     return my_decorator
 
 
+def async_backoff(
+        start_sleep_time=app_config.backoff_start_sleep_time,
+        factor=app_config.backoff_factor,
+        border_sleep_time=app_config.backoff_border_sleep_time,
+        logy=None
+):
+    """
+        Вариант backoff для корутин: между попытками не блокирует цикл событий (asyncio.sleep).
+        Параметры и формула роста времени повтора те же, что и у backoff
+    """
+    if not logy:
+        logy = log.getChild('async_backoff_some_func')
+
+    def my_decorator(f):
+
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            t = start_sleep_time
+            counter = 1
+            while True:
+                try:
+                    return await f(*args, **kwargs)
+
+                except Exception:
+                    logy.exception(f'Connection failed, reconnection attempt #{counter}, wait time - {t} sec')
+                    with stage('backoff.sleep'):
+                        await asyncio.sleep(t)
+                    if t < border_sleep_time:
+                        t = t * 2 ** factor
+                    if t >= border_sleep_time:
+                        t = border_sleep_time
+                    counter += 1
+
+        return wrapper
+
+    return my_decorator
+
+
 if __name__ == '__main__':
     pass
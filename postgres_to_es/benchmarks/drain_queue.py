@@ -0,0 +1,109 @@
+"""
+Бенчмарк разбора стеков обработки: прежние списки со сдвигом (pop(0), del [:n])
+против deque в PGConnector.pop_next_batch и генераторах SidePGConnector.
+Postgres не нужен, get_data подменён пустым ответом.
+Запуск из папки postgres_to_es:
+    python3 -m benchmarks.drain_queue --sizes 1000 10000 100000
+"""
+import argparse
+import time
+import uuid
+from collections import deque
+from datetime import datetime as dt, timezone
+
+from config import pg_config
+from connectors import PGConnector
+from side_updater import SidePGConnector
+
+
+def offline(cls):
+    """Коннектор без соединения с Postgres, запросы отдают пустой результат.
+    __init__ не вызывается, а __del__ подкласса не закрывает курсор и не возвращает соединение в пул
+    """
+    offline_cls = type(f'Offline{cls.__name__}', (cls,), {'__del__': lambda self: None})
+    pg = offline_cls.__new__(offline_cls)
+    pg.rows = []
+    pg.ids_to_update = deque()
+    pg.work_queue = {}
+    pg.fanout = deque()
+    pg.seen = set()
+    pg.checkpoints = {}
+
+    def get_data(execute, params=None, size=None):
+        pg.rows = []
+
+    pg.get_data = get_data
+    return pg
+
+
+def films(size: int) -> list:
+    now = dt.now(timezone.utc)
+    return [(str(uuid.uuid4()), now) for _ in range(size)]
+
+
+def side_rows(size: int) -> list:
+    now = dt.now(timezone.utc)
+    return [(str(uuid.uuid4()), 'name', None, now) for _ in range(size)]
+
+
+def list_pop_front(items: list):
+    items = list(items)
+    while items:
+        items.pop(0)
+
+
+def list_slice_batches(items: list):
+    items = list(items)
+    while items:
+        _ = items[:pg_config.bulk_factor]
+        del items[:pg_config.bulk_factor]
+
+
+def deque_pop_next_batch(items: list):
+    pg = offline(PGConnector)
+    pg.ids_to_update = deque(items)
+    for _ in pg.pop_next_batch():
+        pass
+
+
+def deque_pop_next_to_update_genre(items: list):
+    pg = offline(SidePGConnector)
+    pg.new_genres = deque(items)
+    for _ in pg.pop_next_to_update_genre():
+        pass
+
+
+def deque_pop_next_to_update_person(items: list):
+    pg = offline(SidePGConnector)
+    pg.new_persons = deque(items)
+    for _ in pg.pop_next_to_update_person():
+        pass
+
+
+CASES = (
+    ('list.pop(0)', list_pop_front, films),
+    ('list del [:bulk_factor]', list_slice_batches, films),
+    ('PGConnector.pop_next_batch', deque_pop_next_batch, films),
+    ('SidePGConnector.pop_next_to_update_genre', deque_pop_next_to_update_genre, side_rows),
+    ('SidePGConnector.pop_next_to_update_person', deque_pop_next_to_update_person, side_rows),
+)
+
+
+def run(sizes: list, repeat: int):
+    for size in sizes:
+        for name, case, make in CASES:
+            items = make(size)
+            best = float('inf')
+            for _ in range(repeat):
+                started = time.perf_counter()
+                case(items)
+                best = min(best, time.perf_counter() - started)
+            print(f'{size:>9} {name:<45} {best * 1000:10.2f} ms {size / best:14.0f} items/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк разбора стеков обработки')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='размеры стека')
+    parser.add_argument('--repeat', type=int, default=3, help='повторов, берётся лучшее время')
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,215 @@
+"""
+Бенчмарк ETL на синтетическом каталоге (benchmarks.generate): полная переиндексация
+и инкрементальные сценарии - массовое переименование персон и жанров, поток новых фильмов.
+Загрузка идёт в локальный ES (--es local) или в записывающую замену клиента (--es recording).
+Результат - JSON с docs/sec, пиковым RSS и временем стадий (profiling) по сценариям,
+его можно сравнивать между коммитами. Каждый сценарий --scenario all идёт в отдельном процессе,
+чтобы пиковый RSS относился только к нему.
+Инкрементальные сценарии двигают контрольные точки состояния из settings/config.toml,
+запускать только на локальном стенде.
+Запуск из папки postgres_to_es:
+    python3 -m benchmarks.etl_bench --scenario all --es recording --count 50 --output bench.json
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime as dt
+
+import pools
+import profiling
+from benchmarks import generate
+from config import app_config, es_config, pg_config
+from connectors import ESConnector, PGConnector, ZERO_UUID
+from logger import log
+from updater import poll_source, update
+
+log = log.getChild(__name__)
+
+LAST_UUID = 'ffffffff-ffff-ffff-ffff-ffffffffffff'
+
+
+class RecordingES:
+    """Замена клиента ES: считает действия и байты bulk запросов и подтверждает их без отправки.
+    Число документов, обновлённых update_by_query, берётся из Postgres (фильмы переименованных персон
+    или жанров) отдельным соединением, этот запрос - стадия recording.count
+    """
+
+    def __init__(self, pg: PGConnector):
+        self.pg = pg
+        self.actions = 0
+        self.bytes = 0
+
+    def bulk(self, body: bytes, index=None, params=None, **kwargs) -> dict:
+        self.actions += sum(1 for line in body.split(b'\n') if line.startswith((b'{"index"', b'{"delete"')))
+        self.bytes += len(body)
+        return {'errors': False}
+
+    def update_by_query(self, index=None, body=None, **kwargs) -> dict:
+        ids = list(body['script']['params']['names'])
+        # Переименование жанров - один nested запрос по genre, персон - bool по ролям
+        source = 'g' if 'nested' in body['query'] else 'p'
+        with profiling.stage('recording.count'):
+            updated = len(set(self.pg.get_films_of(source, ids)))
+        return {'updated': updated, 'failures': []}
+
+
+class BenchESConnector(ESConnector):
+    """ESConnector, который считает документы, обновлённые частичными обновлениями"""
+
+    def __init__(self):
+        super().__init__()
+        self.partially_updated = 0
+
+    def _update_by_query(self, query: dict, script: str, names: dict) -> int:
+        updated = super()._update_by_query(query, script, names)
+        self.partially_updated += updated
+        return updated
+
+
+def full_reindex(pg: PGConnector, es: ESConnector) -> int:
+    """Все фильмы по возрастанию uuid, как одна партиция reindex.py, отдаёт их число"""
+    after, count = ZERO_UUID, 0
+    while True:
+        pg.get_partition_ids(after, LAST_UUID)
+        if not pg.ids_to_update:
+            return count
+        after = pg.ids_to_update[-1][0]
+        count += len(pg.ids_to_update)
+        update(pg=pg, es=es)
+
+
+def catch_up(pg: PGConnector, es: ESConnector) -> int:
+    """Циклы опроса fw, p и g, пока источники не опустеют, отдаёт число их строк"""
+    total = 0
+    while True:
+        rows = sum(poll_source(source, pg, es) for source in ('fw', 'p', 'g'))
+        update(pg=pg, es=es)
+        pg.commit_queue()
+        total += rows
+        if not rows:
+            return total
+
+
+def scenarios(args) -> dict:
+    """Сценарий: (изменение данных перед замером или None, замеряемый прогон)"""
+    return {
+        'full': (None, full_reindex),
+        'person_rename': (lambda: generate.rename_persons(args.count), catch_up),
+        'genre_rename': (lambda: generate.rename_genres(args.count), catch_up),
+        'trickle': (lambda: generate.add_films(args.count, args.roles_per_film, args.genres_per_film), catch_up),
+    }
+
+
+def measure(name: str, prepare, run, pg: PGConnector, es: BenchESConnector) -> dict:
+    if prepare is not None:
+        catch_up(pg, es)
+        prepare()
+    es.partially_updated = 0
+    started = time.perf_counter()
+    with profiling.cycle() as trace:
+        rows = run(pg, es)
+    seconds = time.perf_counter() - started
+    indexed = trace.stats['serialize'][0] if 'serialize' in trace.stats else 0
+    documents = indexed + es.partially_updated
+    return {
+        'scenario': name,
+        'source_rows': rows,
+        'documents': documents,
+        'indexed': indexed,
+        'partially_updated': es.partially_updated,
+        'seconds': round(seconds, 3),
+        'docs_per_sec': round(documents / seconds, 1) if seconds else None,
+        # Пиковый RSS процесса сценария (Linux - в килобайтах)
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages': {
+            stage: {'calls': calls, 'wall': round(wall, 4), 'cpu': round(cpu, 4)}
+            for stage, (calls, wall, cpu) in sorted(trace.stats.items())
+        },
+    }
+
+
+def commit_id():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scenario(args) -> dict:
+    """Замер одного сценария args.scenario в текущем процессе"""
+    app_config.profile = True
+    if args.es == 'recording':
+        # Общий клиент процесса подменяется до создания коннекторов, ES не нужен
+        pools._es_clients[os.getpid()] = RecordingES(PGConnector())
+    es = BenchESConnector()
+    es.index = args.index
+    es.fingerprints = None
+    if args.es == 'local' and not es.is_index_exist(args.index):
+        es.create_indexes(args.index, es_config.default_scheme_file)
+    pg = PGConnector()
+
+    prepare, run = scenarios(args)[args.scenario]
+    result = measure(args.scenario, prepare, run, pg, es)
+    log.info(
+        f'{args.scenario}: {result["documents"]} docs in {result["seconds"]} sec, {result["docs_per_sec"]} docs/sec'
+    )
+    return result
+
+
+def run_isolated(args, name: str) -> dict:
+    """Замер сценария name в отдельном процессе: пиковый RSS не наследуется от предыдущих сценариев"""
+    command = [
+        sys.executable, '-m', 'benchmarks.etl_bench', '--scenario', name, '--es', args.es, '--index', args.index,
+        '--count', str(args.count), '--roles-per-film', str(args.roles_per_film),
+        '--genres-per-film', str(args.genres_per_film),
+    ]
+    # Лог сценария идёт в stderr, в stdout - только JSON отчёт
+    report = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout
+    return json.loads(report)['results'][0]
+
+
+def bench(args) -> dict:
+    if args.scenario == 'all':
+        results = [run_isolated(args, name) for name in scenarios(args)]
+    else:
+        results = [run_scenario(args)]
+    return {
+        'commit': commit_id(),
+        'time': dt.now().isoformat(),
+        'es': args.es,
+        'settings': {
+            'pg_bulk_factor': pg_config.bulk_factor,
+            'es_bulk_factor': es_config.bulk_factor,
+            'inflight_bulk': es_config.inflight_bulk,
+            'batch_extract': pg_config.batch_extract,
+            'batch_transform': app_config.batch_transform,
+            'partial_updates': app_config.partial_updates,
+        },
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк ETL на синтетическом каталоге')
+    parser.add_argument(
+        '--scenario', default='all', choices=['all', 'full', 'person_rename', 'genre_rename', 'trickle']
+    )
+    parser.add_argument('--es', default='recording', choices=['recording', 'local'], help='куда загружать')
+    parser.add_argument('--index', default='movies_bench', help='индекс для --es local')
+    parser.add_argument('--count', type=int, default=50, help='персон, жанров или новых фильмов в сценарии')
+    parser.add_argument('--roles-per-film', type=int, default=8)
+    parser.add_argument('--genres-per-film', type=int, default=2)
+    parser.add_argument('--output', help='файл для JSON результата (по умолчанию - stdout)')
+    args = parser.parse_args()
+    report = json.dumps(bench(args), indent=4, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
@@ -0,0 +1,158 @@
+"""
+Генератор синтетического каталога content.* в локальном Postgres (из settings/config.toml)
+и изменения данных для сценариев бенчмарка. Схема - Docker-settings/postgres/init.sql.
+Запуск из папки postgres_to_es:
+    python3 -m benchmarks.generate --films 100000 --persons 50000 --genres 40 --truncate
+"""
+import argparse
+import random
+import uuid
+from datetime import date, datetime as dt, timedelta, timezone
+
+from psycopg2.extras import execute_values
+
+from logger import log
+from pools import get_pg_connection, release_pg_connection
+
+log = log.getChild(__name__)
+
+CHUNK = 5000
+TABLES = ('person_film_work', 'genre_film_work', 'film_work', 'person', 'genre', 'etl_tombstone')
+
+
+def make_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def insert(connection, table: str, columns: tuple, rows: list):
+    """Вставить строки пачками по CHUNK"""
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), CHUNK):
+            execute_values(
+                cursor,
+                f'INSERT INTO content.{table} ({", ".join(columns)}) VALUES %s',
+                rows[start:start + CHUNK],
+            )
+    connection.commit()
+
+
+def film_rows(rng: random.Random, count: int, person_ids: list, genre_ids: list,
+              roles_per_film: int, genres_per_film: int, first: int = 0) -> tuple:
+    """Строки film_work, person_film_work и genre_film_work для count фильмов.
+    Первая роль фильма - режиссёр, вторая - сценарист, остальные - актёры
+    """
+    now = dt.now(timezone.utc)
+    films, persons, genres = [], [], []
+    for number in range(first, first + count):
+        film_id = make_uuid(rng)
+        films.append((
+            film_id, f'Film {number}', f'Synthetic film number {number}', date(rng.randint(1950, 2021), 1, 1),
+            round(rng.uniform(1, 10), 1), 'movie', now, now
+        ))
+        for position, person_id in enumerate(rng.sample(person_ids, min(roles_per_film, len(person_ids)))):
+            role = 'director' if position == 0 else 'writer' if position == 1 else 'actor'
+            persons.append((make_uuid(rng), film_id, person_id, role, now))
+        for genre_id in rng.sample(genre_ids, min(genres_per_film, len(genre_ids))):
+            genres.append((make_uuid(rng), film_id, genre_id, now))
+    return films, persons, genres
+
+
+def insert_films(connection, films: list, persons: list, genres: list):
+    insert(connection, 'film_work',
+           ('id', 'title', 'description', 'creation_date', 'rating', 'type', 'created_at', 'updated_at'), films)
+    insert(connection, 'person_film_work', ('id', 'film_work_id', 'person_id', 'role', 'created_at'), persons)
+    insert(connection, 'genre_film_work', ('id', 'film_work_id', 'genre_id', 'created_at'), genres)
+
+
+def generate(films: int, persons: int, genres: int, roles_per_film: int, genres_per_film: int,
+             seed: int = 0, truncate: bool = False):
+    """Заполнить content.* синтетическим каталогом, одинаковым для одинаковых параметров и seed"""
+    rng = random.Random(seed)
+    now = dt.now(timezone.utc)
+    connection = get_pg_connection()
+    try:
+        if truncate:
+            with connection.cursor() as cursor:
+                # content.etl_tombstone есть, только если включались удаления (deletions)
+                cursor.execute('SELECT to_regclass(%s);', ('content.etl_tombstone',))
+                tables = TABLES if cursor.fetchone()[0] else TABLES[:-1]
+                cursor.execute(f'TRUNCATE {", ".join(f"content.{table}" for table in tables)};')
+            connection.commit()
+        person_rows = [
+            (make_uuid(rng), f'Person {number}', date(1940, 1, 1) + timedelta(days=rng.randint(0, 25000)), now, now)
+            for number in range(persons)
+        ]
+        insert(connection, 'person', ('id', 'full_name', 'birth_date', 'created_at', 'updated_at'), person_rows)
+        genre_rows = [(make_uuid(rng), f'Genre {number}', f'Synthetic genre {number}', now, now)
+                      for number in range(genres)]
+        insert(connection, 'genre', ('id', 'name', 'description', 'created_at', 'updated_at'), genre_rows)
+        insert_films(connection, *film_rows(
+            rng, films, [p[0] for p in person_rows], [g[0] for g in genre_rows], roles_per_film, genres_per_film
+        ))
+    finally:
+        release_pg_connection(connection)
+    log.info(f'Generated {films} films, {persons} persons, {genres} genres')
+
+
+def _execute(sql: str, params=None) -> int:
+    connection = get_pg_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            count = cursor.rowcount
+        connection.commit()
+        return count
+    finally:
+        release_pg_connection(connection)
+
+
+def rename_persons(count: int) -> int:
+    """Переименовать count персон с наибольшим числом ролей (массовое переименование), отдаёт их число"""
+    return _execute(
+        '''UPDATE content.person SET full_name = full_name || ' renamed', updated_at = now()
+        WHERE id IN (SELECT person_id FROM content.person_film_work
+                     GROUP BY person_id ORDER BY count(*) DESC, person_id LIMIT %s)''',
+        (count,)
+    )
+
+
+def rename_genres(count: int) -> int:
+    """Переименовать count самых частых жанров, отдаёт их число"""
+    return _execute(
+        '''UPDATE content.genre SET name = name || ' renamed', updated_at = now()
+        WHERE id IN (SELECT genre_id FROM content.genre_film_work
+                     GROUP BY genre_id ORDER BY count(*) DESC, genre_id LIMIT %s)''',
+        (count,)
+    )
+
+
+def add_films(count: int, roles_per_film: int, genres_per_film: int, seed: int = 1) -> int:
+    """Добавить count новых фильмов с существующими персонами и жанрами (поток новых фильмов)"""
+    connection = get_pg_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id FROM content.person;')
+            person_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SELECT id FROM content.genre;')
+            genre_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute('SELECT count(*) FROM content.film_work;')
+            first = cursor.fetchone()[0]
+        # Номер первого нового фильма входит в seed, повторный запуск не повторяет uuid
+        rng = random.Random(f'{seed}:{first}')
+        insert_films(connection, *film_rows(rng, count, person_ids, genre_ids, roles_per_film, genres_per_film, first))
+    finally:
+        release_pg_connection(connection)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Синтетический каталог фильмов в локальном Postgres')
+    parser.add_argument('--films', type=int, default=10000)
+    parser.add_argument('--persons', type=int, default=5000)
+    parser.add_argument('--genres', type=int, default=30)
+    parser.add_argument('--roles-per-film', type=int, default=8)
+    parser.add_argument('--genres-per-film', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--truncate', action='store_true', help='очистить content.* перед генерацией')
+    args = parser.parse_args()
+    generate(args.films, args.persons, args.genres, args.roles_per_film, args.genres_per_film, args.seed, args.truncate)
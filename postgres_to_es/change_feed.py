@@ -0,0 +1,66 @@
+import select
+import time
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from backoff_decorator import backoff
+from config import app_config, dsl
+from logger import log
+
+log = log.getChild(__name__)
+
+
+class ChangeListener:
+    """
+    Подписка (LISTEN) на уведомления триггеров таблиц content.* (создаются PGConnector.prepare_change_feed).
+    Вместо фиксированного сна цикл обновления ждёт уведомления не дольше await_time,
+    опрос таблиц по контрольным точкам остаётся путём догрузки
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.connect()
+
+    @backoff(logy=log.getChild('ChangeListener.connect'))
+    def connect(self):
+        self.connection = psycopg2.connect(**dsl)
+        self.connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.connection.cursor() as cursor:
+            # Канал в кавычках: pg_notify в функции триггеров передаёт имя канала как есть, без нижнего регистра
+            cursor.execute(sql.SQL('LISTEN {};').format(sql.Identifier(app_config.notify_channel)))
+
+    def wait(self, timeout: float) -> set:
+        """Ждать уведомлений не дольше timeout сек, отдаёт множество изменённых таблиц.
+        Пачка изменений собирается ещё notify_debounce сек после первого уведомления
+        """
+        try:
+            tables = self._collect(timeout)
+            if tables:
+                tables |= self._collect(app_config.notify_debounce)
+            return tables
+        except (psycopg2.Error, OSError):
+            log.exception('Change feed connection lost, reconnect')
+            self.connect()
+            return {'reconnect'}
+
+    def _collect(self, timeout: float) -> set:
+        deadline = time.monotonic() + timeout
+        tables = set()
+        while not tables:
+            left = deadline - time.monotonic()
+            if left <= 0 or select.select([self.connection], [], [], left) == ([], [], []):
+                break
+            self.connection.poll()
+            tables = {notify.payload for notify in self.connection.notifies}
+            self.connection.notifies.clear()
+        return tables
+
+    def __del__(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+if __name__ == '__main__':
+    pass
@@ -1,73 +1,473 @@
 import json
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 
-import psycopg2
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, RequestError
+from psycopg2 import sql
 from psycopg2.extras import DictCursor
 
 from backoff_decorator import backoff
-from config import pg_config, es_config, dsl, movies_index
+from config import pg_config, es_config, app_config, movies_index, genre_index, person_index
+from fingerprints import FingerprintStore, fingerprint
 from logger import log
-from storage import State, JsonFileStorage
+from metrics import BULK_BYTES, BULK_DOCS, BULK_ERRORS, DOCS_SKIPPED, ROWS_EXTRACTED, timed
+from pools import check_pg_connection, es_client, get_pg_connection, release_pg_connection
+from profiling import traced
+from serializer import action_id, bulk_body, delete_action, index_action
+from storage import State, get_storage
+
+ZERO_UUID = '00000000-0000-0000-0000-000000000000'
+# Статусы ES, с которыми документ стоит отправить повторно
+RETRY_STATUSES = (429, 503)
+# Поля фильма, в которых встречается персона
+PERSON_ROLES = ('actors', 'writers', 'directors')
+# Переименование персон в документах фильмов: имена во вложенных списках и пересборка строк имён
+RENAME_PERSONS_SCRIPT = """
+Set names(def persons) {
+    Set result = new TreeSet();
+    if (persons != null) {
+        for (def person : persons) { result.add(person.full_name); }
+    }
+    return result;
+}
+for (def role : ['actors', 'writers', 'directors']) {
+    if (ctx._source[role] == null) { continue; }
+    for (def person : ctx._source[role]) {
+        if (params.names.containsKey(person.uuid)) { person.full_name = params.names[person.uuid]; }
+    }
+}
+Set actors = names(ctx._source.actors);
+Set writers = names(ctx._source.writers);
+Set directors = names(ctx._source.directors);
+ctx._source.actors_names = actors.isEmpty() ? null : String.join(', ', actors);
+ctx._source.writers_names = writers.isEmpty() ? null : new ArrayList(writers);
+ctx._source.director = directors.isEmpty() ? null : String.join(', ', directors);
+"""
+# Переименование жанров в документах фильмов
+RENAME_GENRES_SCRIPT = """
+if (ctx._source.genre == null) { return; }
+for (def genre : ctx._source.genre) {
+    if (params.names.containsKey(genre.uuid)) { genre.name = params.names[genre.uuid]; }
+}
+"""
+# Слагаемые контрольных сумм диапазона uuid для сверки с Postgres (audit.py):
+# первые 32 бита uuid и updated_at фильма в секундах
+AUDIT_ID_SCRIPT = "Long.parseLong(doc['id'].value.substring(0, 8), 16)"
+AUDIT_TIME_SCRIPT = "doc['updated_at'].size() == 0 ? 0 : doc['updated_at'].value.toEpochSecond()"
+# Таблица записей об удалённых строках и триггеры удаления (как в init.sql) для баз, созданных без них.
+# Триггеры создаются, только если их ещё нет, чтобы не брать блокировки таблиц content.* на каждом старте
+TOMBSTONE_DDL = """
+CREATE TABLE IF NOT EXISTS content.etl_tombstone (
+    id bigserial PRIMARY KEY,
+    table_name text NOT NULL,
+    row_id uuid NOT NULL,
+    film_work_id uuid,
+    deleted_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE OR REPLACE FUNCTION content.etl_tombstone() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME IN ('person_film_work', 'genre_film_work') THEN
+        INSERT INTO content.etl_tombstone (table_name, row_id, film_work_id)
+            VALUES (TG_TABLE_NAME, OLD.id, OLD.film_work_id);
+    ELSE
+        INSERT INTO content.etl_tombstone (table_name, row_id) VALUES (TG_TABLE_NAME, OLD.id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['film_work', 'person', 'genre', 'person_film_work', 'genre_film_work'] LOOP
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = t || '_etl_tombstone' AND tgrelid = ('content.' || t)::regclass) THEN
+            EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON content.%I '
+                           || 'FOR EACH ROW EXECUTE FUNCTION content.etl_tombstone()', t || '_etl_tombstone', t);
+        END IF;
+    END LOOP;
+END;
+$$;
+"""
+# Уведомления об изменениях content.* для change_feed, {channel} - канал app.notify_channel.
+# Функция пересоздаётся при каждом старте, чтобы канал в ней совпадал с настройками
+NOTIFY_DDL = """
+CREATE OR REPLACE FUNCTION content.notify_etl() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify({channel}, TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DO $$
+DECLARE
+    t text;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['film_work', 'person', 'genre', 'person_film_work', 'genre_film_work'] LOOP
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                       WHERE tgname = t || '_notify_etl' AND tgrelid = ('content.' || t)::regclass) THEN
+            EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON content.%I '
+                           || 'FOR EACH STATEMENT EXECUTE FUNCTION content.notify_etl()', t || '_notify_etl', t);
+        END IF;
+    END LOOP;
+END;
+$$;
+"""
+
+
+def next_sleep_time(t: float) -> float:
+    """Следующее время ожидания перед повтором по формуле backoff"""
+    return min(t * 2 ** app_config.backoff_factor, app_config.backoff_border_sleep_time)
+
+
+def dead_letter(index: str, line: bytes, action: dict):
+    """Записать отвергнутый ES документ в файл недоставленных сообщений (json lines)"""
+    log.error(f'Document rejected by index:{index}, status {action.get("status")}: {action.get("error")}')
+    record = {
+        'time': dt.now().isoformat(),
+        'index': index,
+        'status': action.get('status'),
+        'error': action.get('error'),
+        'action': line.decode(),
+    }
+    with open(app_config.dead_letter_file_path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+def split_bulk_response(block: list, res: dict, index: str) -> tuple:
+    """Разобрать ответ bulk по документам: успешные пропустить, отвергнутые насовсем
+    отправить в dead_letter. Отдаёт строки пачки, которые нужно отправить повторно, и uuid отвергнутых
+    """
+    retry, rejected = [], []
+    for line, item in zip(block, res.get('items', [])):
+        action = next(iter(item.values()))
+        if 'error' not in action:
+            continue
+        BULK_ERRORS.labels(index, str(action.get('status'))).inc()
+        if action.get('status') in RETRY_STATUSES:
+            retry.append(line)
+        else:
+            dead_letter(index, line, action)
+            rejected.append(action_id(line))
+    return retry, rejected
+
+
+def drop_rejected(block_fingerprints: list, rejected: set) -> list:
+    """Хеши пачки без документов, отвергнутых ES: их хеш не сохраняется, иначе документ не отправится повторно"""
+    if not rejected:
+        return block_fingerprints
+    return [(uuid, digest) for uuid, digest in block_fingerprints if str(uuid) not in rejected]
+
+
+@traced('es.bulk')
+@backoff(logy=log.getChild('bulk_request'))
+def bulk_request(connection: Elasticsearch, block: list, index: str) -> dict:
+    return connection.bulk(
+        body=bulk_body(block), index=index, params={'filter_path': 'errors,items.*.status,items.*.error'}
+    )
+
+
+def send_bulk(connection: Elasticsearch, block: list, index: str) -> set:
+    """Загрузить пачку в ES, повторяя с нарастающей паузой только документы с 429/503.
+    Отдаёт uuid документов, отвергнутых ES насовсем (записаны в dead_letter)
+    """
+    t = app_config.backoff_start_sleep_time
+    rejected = set()
+    while block:
+        with timed('load'):
+            res = bulk_request(connection, block, index)
+        BULK_BYTES.labels(index).inc(sum(len(line) for line in block))
+        retry, block_rejected = split_bulk_response(block, res, index) if res.get('errors') else ([], [])
+        rejected.update(block_rejected)
+        # Подтверждены ES только документы без ошибок: без повторяемых и без отвергнутых насовсем
+        confirmed = len(block) - len(retry) - len(block_rejected)
+        BULK_DOCS.labels(index).inc(confirmed)
+        log.info(f'Add block to index:{index} of {confirmed} records')
+        if retry:
+            log.warning(f'Retry {len(retry)} records to index:{index} in {t} sec')
+            time.sleep(t)
+            t = next_sleep_time(t)
+        block = retry
+    return rejected
 
 
 class ESConnector:
     @backoff(logy=log.getChild('ESConnector.init'))
     def __init__(self):
-        self.connection = Elasticsearch(host=es_config.ES_URL)
-        self.connection.cluster.health(wait_for_status='yellow', request_timeout=1)
+        self.connection = es_client()
+        self.index = movies_index
         self.block = []
-        self.last_time = None
-        self.state = State(JsonFileStorage())
+        self.block_bytes = 0
+        self.pool = ThreadPoolExecutor(max_workers=es_config.inflight_bulk)
+        self.pending = deque()
+        self.fingerprints = FingerprintStore() if app_config.fingerprints else None
+        self.block_fingerprints = []
 
-    @backoff(logy=log.getChild('ESConnector.load'))
     def load(self):
-        """ Загрузить в ES пачку подготовленных данных и записать в состояния
-        время последней строки
+        """ Отправить в ES пачку подготовленных данных через пул потоков,
+        в полёте одновременно до es_config.inflight_bulk пачек.
+        Хеши документов пачки записываются только после того, как подтверждены все более ранние пачки
         """
 
         if not self.block:
             return
-        body = '\n'.join(self.block)
-        res = self.connection.bulk(body=body, index=movies_index, params={'filter_path': 'items.*.error'})
-        if not res:
-            log.info(f'Add block of {len(self.block)} records')
-            self.block.clear()
-            self.state.set_state('fw', self.last_time)
-        else:
-            print(res)
+        future = self.pool.submit(send_bulk, self.connection, self.block, self.index)
+        self.pending.append((future, self.block_fingerprints))
+        self.block = []
+        self.block_bytes = 0
+        self.block_fingerprints = []
+        self._commit(limit=es_config.inflight_bulk)
+
+    def wait_all(self):
+        """Дождаться подтверждения всех отправленных пачек"""
+        self._commit(limit=0)
+
+    def _commit(self, limit: int):
+        """Записать хеши подтверждённых по порядку пачек, ожидая пока в полёте не станет limit и меньше"""
+        while self.pending and (len(self.pending) > limit or self.pending[0][0].done()):
+            future, block_fingerprints = self.pending.popleft()
+            rejected = future.result()
+            if self.fingerprints is not None:
+                self.fingerprints.save(self.index, drop_rejected(block_fingerprints, rejected))
 
     def add_to_block(self, doc: dict, uuid: str):
-        index_row = {"index": {"_index": "movies", "_id": f"{uuid}"}}
-        self.block.append(json.dumps(index_row) + '\n' + json.dumps(doc))
+        """Добавить документ в пачку, если он отличается от уже подтверждённого ES"""
+        line = index_action(self.index, doc, uuid)
+        if self.fingerprints is not None:
+            digest = fingerprint(line)
+            if self.fingerprints.is_unchanged(self.index, uuid, digest):
+                DOCS_SKIPPED.inc()
+                return
+            self.block_fingerprints.append((uuid, digest))
+        self.block.append(line)
+        self.block_bytes += len(line)
+
+    def is_block_full(self) -> bool:
+        """Пачка ограничена и числом документов, и размером тела bulk запроса"""
+        return len(self.block) >= es_config.bulk_factor or self.block_bytes >= es_config.bulk_max_bytes
 
     @backoff(logy=log.getChild('ESConnector.is_index_exist'))
     def is_index_exist(self, index: str):
         return self.connection.indices.exists(index=index)
 
-    @backoff(logy=log.getChild('ESConnector.create_index'))
     def create_indexes(self, index: str, file_name: str):
+        """Создать индекс по схеме. Хеши документов прежнего индекса с этим именем забываются,
+        иначе после пересоздания индекса документы считались бы неизменными и не загружались
+        """
+        result = self._create_index(index, file_name)
+        if self.fingerprints is not None:
+            self.fingerprints.forget(index)
+        return result
+
+    @backoff(logy=log.getChild('ESConnector.create_index'))
+    def _create_index(self, index: str, file_name: str):
 
         with open(file_name, 'r') as f:
             self.connection.indices.create(index=index, body=json.load(f))
             return self.connection.indices.get(index=index)
 
+    def prepare_indexes(self):
+        """Создать индексы ES, которых ещё нет"""
+        indexes_files = {
+            movies_index: es_config.default_scheme_file,
+            genre_index: es_config.genres_scheme_file,
+            person_index: es_config.persons_scheme_file,
+        }
+
+        for index, file in indexes_files.items():
+            if not self.is_index_exist(index):
+                result = self.create_indexes(index, file)
+                log.info(f'created index: {result}')
+            else:
+                self.update_mapping(index, file)
+
+    def update_mapping(self, index: str, file_name: str):
+        """Добавить в существующий индекс только поля схемы, которых в нём нет (например, updated_at),
+        прежние поля не меняются. Отказ ES пишется в лог и не останавливает запуск
+        """
+        with open(file_name, 'r') as f:
+            properties = json.load(f)['mappings'].get('properties', {})
+        current = self._mapping_properties(index)
+        missing = {name: field for name, field in properties.items() if name not in current}
+        if not missing:
+            return
+        error = self._put_mapping(index, {'properties': missing})
+        if error is not None:
+            log.error(f'Fields {sorted(missing)} are not added to index:{index}: {error}')
+            return
+        log.info(f'Fields {sorted(missing)} are added to index:{index}')
+
+    @backoff(logy=log.getChild('ESConnector.get_mapping'))
+    def _mapping_properties(self, index: str) -> dict:
+        """Поля индекса (для alias - его первого индекса)"""
+        res = self.connection.indices.get_mapping(index=index)
+        return next(iter(res.values()), {}).get('mappings', {}).get('properties', {})
+
+    @backoff(logy=log.getChild('ESConnector.put_mapping'))
+    def _put_mapping(self, index: str, body: dict):
+        """Отдаёт ошибку запроса (4xx) вместо повтора: несовместимую схему повтор не исправит"""
+        try:
+            self.connection.indices.put_mapping(index=index, body=body)
+        except RequestError as e:
+            return e
+        return None
+
+    @backoff(logy=log.getChild('ESConnector.create_versioned_index'))
+    def create_versioned_index(self, alias: str, file_name: str) -> str:
+        """Создать следующую версию индекса (alias_vN) для заливки: без обновления поиска и без реплик"""
+        names = self.connection.indices.get(index=f'{alias}_v*')
+        versions = [int(v) for v in (name.rpartition('_v')[2] for name in names) if v.isdigit()]
+        index = f'{alias}_v{max(versions, default=0) + 1}'
+        with open(file_name, 'r') as f:
+            body = json.load(f)
+        body['settings'] = {**body.get('settings', {}), 'refresh_interval': '-1', 'number_of_replicas': 0}
+        self.connection.indices.create(index=index, body=body)
+        if self.fingerprints is not None:
+            self.fingerprints.forget(index)
+        return index
+
+    @backoff(logy=log.getChild('ESConnector.finish_versioned_index'))
+    def finish_versioned_index(self, index: str, file_name: str):
+        """Вернуть индексу настройки из схемы после заливки и слить сегменты"""
+        with open(file_name, 'r') as f:
+            settings = json.load(f).get('settings', {})
+        self.connection.indices.put_settings(index=index, body={'index': {
+            'refresh_interval': settings.get('refresh_interval', '1s'),
+            'number_of_replicas': settings.get('number_of_replicas', 1),
+        }})
+        self.connection.indices.forcemerge(
+            index=index, max_num_segments=1, request_timeout=es_config.forcemerge_timeout
+        )
+        self.connection.indices.refresh(index=index)
+
+    @backoff(logy=log.getChild('ESConnector.swap_alias'))
+    def swap_alias(self, alias: str, index: str) -> list:
+        """Атомарно переключить alias на index, отдаёт индексы, с которых alias снят.
+        Старый индекс с именем alias (до перехода на версии) удаляется в том же запросе.
+        Если alias уже указывает на index (повтор после обрыва ответа), index в списке снятых не окажется
+        """
+        actions = []
+        if self.connection.indices.exists_alias(name=alias):
+            old = [name for name in self.connection.indices.get_alias(name=alias) if name != index]
+            actions = [{'remove': {'index': name, 'alias': alias}} for name in old]
+        elif self.connection.indices.exists(index=alias):
+            old = [alias]
+            actions = [{'remove_index': {'index': alias}}]
+        else:
+            old = []
+        actions.append({'add': {'index': index, 'alias': alias}})
+        self.connection.indices.update_aliases(body={'actions': actions})
+        return old
+
+    def delete_documents(self, index: str, ids: list):
+        """Удалить документы ids из индекса пачками по es_config.bulk_factor.
+        Отсутствующий документ (404) ошибкой не считается
+        """
+        for start in range(0, len(ids), es_config.bulk_factor):
+            block = [delete_action(index, uuid) for uuid in ids[start:start + es_config.bulk_factor]]
+            send_bulk(self.connection, block, index)
+            log.info(f'Delete {len(block)} records from index:{index}')
+        if index == self.index and self.fingerprints is not None:
+            self.fingerprints.forget_ids(index, ids)
+
+    @backoff(logy=log.getChild('ESConnector.range_checksum'))
+    def range_checksum(self, after: str, last: str) -> tuple:
+        """Число фильмов диапазона uuid (after, last] и суммы их AUDIT_ID_SCRIPT и AUDIT_TIME_SCRIPT"""
+        res = self.connection.search(index=self.index, body={
+            'size': 0,
+            'track_total_hits': True,
+            'query': {'range': {'id': {'gt': after, 'lte': last}}},
+            'aggs': {
+                'ids': {'sum': {'script': AUDIT_ID_SCRIPT}},
+                'times': {'sum': {'script': AUDIT_TIME_SCRIPT}},
+            },
+        })
+        aggs = res['aggregations']
+        return res['hits']['total']['value'], int(aggs['ids']['value']), int(aggs['times']['value'])
+
+    @backoff(logy=log.getChild('ESConnector.range_page'))
+    def _range_page(self, after: str, last: str) -> list:
+        res = self.connection.search(index=self.index, body={
+            'size': es_config.bulk_factor,
+            'query': {'range': {'id': {'gt': after, 'lte': last}}},
+            'sort': [{'id': 'asc'}],
+            '_source': ['updated_at'],
+        })
+        return res['hits']['hits']
+
+    def range_ids(self, after: str, last: str) -> dict:
+        """uuid -> updated_at фильмов диапазона (after, last], постранично по возрастанию uuid"""
+        ids = {}
+        while True:
+            hits = self._range_page(after, last)
+            if not hits:
+                return ids
+            for hit in hits:
+                ids[hit['_id']] = hit['_source'].get('updated_at')
+            after = hits[-1]['_id']
+
+    def rename_persons(self, names: dict) -> int:
+        """Частичное обновление фильмов с персонами names (uuid -> full_name) без их повторной выборки"""
+        query = {'bool': {'should': [
+            {'nested': {'path': role, 'query': {'terms': {f'{role}.uuid': list(names)}}}} for role in PERSON_ROLES
+        ]}}
+        return self._update_by_query(query, RENAME_PERSONS_SCRIPT, names)
+
+    def rename_genres(self, names: dict) -> int:
+        """Частичное обновление фильмов с жанрами names (uuid -> name) без их повторной выборки"""
+        query = {'nested': {'path': 'genre', 'query': {'terms': {'genre.uuid': list(names)}}}}
+        return self._update_by_query(query, RENAME_GENRES_SCRIPT, names)
+
+    @traced('es.update_by_query')
+    @backoff(logy=log.getChild('ESConnector.update_by_query'))
+    def _update_by_query(self, query: dict, script: str, names: dict) -> int:
+        """update_by_query по индексу фильмов, отдаёт число обновлённых документов.
+        Конфликт версий значит, что документ уже перезаписан свежими данными, такие пропускаются
+        """
+        res = self.connection.update_by_query(
+            index=self.index,
+            body={'query': query, 'script': {'source': script, 'lang': 'painless', 'params': {'names': names}}},
+            conflicts='proceed',
+            refresh=True,
+            request_timeout=es_config.partial_update_timeout,
+        )
+        if res.get('failures'):
+            raise RuntimeError(f'update_by_query on index:{self.index} failed: {res["failures"][:3]}')
+        log.info(f'Partially updated {res.get("updated", 0)} records')
+        return res.get('updated', 0)
+
     def __del__(self):
-        self.connection.close()
+        self.pool.shutdown(wait=False)
 
 
 class PGConnector:
 
     @backoff(logy=log.getChild('PGConnector.init'))
     def __init__(self):
-        self.connection = psycopg2.connect(**dsl, cursor_factory=DictCursor)
+        self.connection = get_pg_connection()
+        # Запросы get_data выполняются вне транзакции: соединение пула живёт весь процесс,
+        # и сессия не должна оставаться idle in transaction с блокировками content.*
+        self.connection.autocommit = True
         self.cursor = self.connection.cursor()
-        self.state = State(JsonFileStorage())
-        self.last_time = None
+        self.state = State(get_storage())
         self.rows = None
         self.genres_to_update = []
-        self.not_complete = {'fw': True, 'p': True, 'g': True}
+        # Стек обработки: (uuid, updated_at) фильмов, разбирается с начала за O(1)
+        self.ids_to_update = deque()
+        # Очередь цикла: uuid фильма -> наибольший updated_at, фильм попадает в неё один раз за цикл
+        self.work_queue = {}
+        # Ленивые потоки uuid фильмов, затронутых изменениями person/genre: читаются пачками по мере обработки
+        self.fanout = deque()
+        # uuid фильмов, уже переданных в обработку в этом цикле
+        self.seen = set()
+        # Контрольные точки источников очереди, записываются после подтверждения её фильмов в ES
+        self.checkpoints = {}
+        # id прочитанных записей об удалении, удаляются из content.etl_tombstone после подтверждения очереди
+        self.tombstones = []
 
+    @traced('pg.get_data')
     @backoff(logy=log.getChild('PGConnector.get_data'))
     def get_data(self, execute: str, params=None, size=None):
         """ Получить данные из Postgres
@@ -77,90 +477,292 @@ class PGConnector:
         """
         if params is None:
             params = []
-        if self.connection.close:
-            self.connection = psycopg2.connect(**dsl, cursor_factory=DictCursor)
-            self.cursor = self.connection.cursor()
+        self._check_connection()
         self.cursor.execute(execute, vars=params)
         if size:
             self.rows = self.cursor.fetchmany(size=size)
         else:
             self.rows = self.cursor.fetchall()
 
+    def stream_data(self, execute: str, params=None, size=pg_config.stream_chunk_size):
+        """ Потоково получить данные из Postgres через именованный (серверный) курсор,
+        результат не материализуется в памяти целиком, а отдаётся пачками
+         : execute SQL запрос
+         : params Параметры SQL запроса если таковые имеются
+         : size размер пачки записей
+        """
+        if params is None:
+            params = []
+        self._check_connection()
+        # Именованный курсор живёт только в транзакции, она завершается сразу после закрытия курсора
+        self.connection.autocommit = False
+        cursor = self.connection.cursor(name=f'etl_stream_{uuid.uuid4().hex}', cursor_factory=DictCursor)
+        cursor.itersize = size
+        try:
+            cursor.execute(execute, vars=params)
+            while True:
+                rows = cursor.fetchmany(size=size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+            if not self.connection.closed:
+                self.connection.rollback()
+                self.connection.autocommit = True
+
+    def _check_connection(self):
+        """Переподключиться только если соединение действительно потеряно"""
+        connection = check_pg_connection(self.connection)
+        if connection is not self.connection:
+            self.connection = connection
+            self.connection.autocommit = True
+            self.cursor = connection.cursor()
+
     def set_start_time(self):
         """
         Если модуль запущен в первый раз:
-        1) Устанавливает топ времени для таблиц p - person и g - genre
+        1) Устанавливает топ ключа (updated_at, id) для таблиц p - person и g - genre
         2) Устанавливает теоретическую дату начала времен кинотеатра для таблицы fw - film_works
         """
         self.get_data(pg_config.sql_get_top_time_person, size=1)
-        p_time = self.rows[0][0]
+        p_time, p_id = self.rows[0]
         self.state.set_state('p', p_time)
+        self.state.set_state('p_id', p_id)
         self.get_data(pg_config.sql_get_top_time_genre, size=1)
-        g_time = self.rows[0][0]
+        g_time, g_id = self.rows[0]
         self.state.set_state('g', g_time)
-        self.last_time = dt.fromisoformat('1999-01-01 12:00:00.000001+00:00')
-        self.state.set_state('fw', self.last_time)
+        self.state.set_state('g_id', g_id)
+        self.state.set_state('fw', dt.fromisoformat('1999-01-01 12:00:00.000001+00:00'))
+        self.state.set_state('fw_id', ZERO_UUID)
 
-    def is_not_complete(self):
-        for _, v in self.not_complete.items():
-            if v:
-                return True
-        return False
-
-    def get_films_ids(self):
-        """Получение списка непроиндексированных записей фильмов (их uuid и updated_at)"""
+    def get_films_ids(self) -> int:
+        """Поместить в очередь цикла страницу непроиндексированных фильмов (их uuid и updated_at)
+        по ключу (updated_at, id) последнего проиндексированного фильма, отдаёт размер страницы
+        """
         if not self.state.get_state('fw'):
             self.set_start_time()
-        self.last_time = dt.fromisoformat(self.state.get_state('fw'))
-        self.get_data(pg_config.sql_get_new_ids, params=[self.last_time, ], size=pg_config.bulk_factor)
-        self.ids_to_update = self.rows
-        self.not_complete['fw'] = len(self.rows) != 0
+        fw_last_time = dt.fromisoformat(self.state.get_state('fw'))
+        fw_last_id = self.state.get_state('fw_id') or ZERO_UUID
+        self.get_data(pg_config.sql_get_new_ids, params=(fw_last_time, fw_last_id, pg_config.bulk_factor))
+        if self.rows:
+            self._enqueue(self.rows)
+            self.defer_checkpoint('fw', self.rows[-1][1], self.rows[-1][0])
+        return len(self.rows)
+
+    def get_partition_ids(self, after: str, last: str):
+        """Получение страницы uuid фильмов партиции полной переиндексации (after, last] по возрастанию id.
+        Контрольную точку fw такие фильмы не двигают
+        """
+        self.get_data(pg_config.sql_get_partition_ids, params=(after, last, pg_config.bulk_factor))
+        self.ids_to_update = deque(self.rows)
+
+    def push_changed_since(self, since: dt):
+        """Поместить в очередь uuid фильмов, изменённых после since напрямую или через person/genre"""
+        self._push_ids(pg_config.sql_get_changed_since, params=(since, since, since))
 
     def pop_next_to_update(self):
         """Получение списка денормизированных данных общей таблицы по фильмам для uuid из стека"""
-        while self.ids_to_update:
-            ids, updated_at = self.ids_to_update.pop(0)
-            self.get_data(pg_config.sql_get_film, params=[ids, ])
-            if self.last_time < updated_at:
-                self.last_time = updated_at
+        if pg_config.batch_extract:
+            yield from self._pop_next_batch()
+            return
+        self._drain_queue()
+        while self._refill(1):
+            ids, updated_at = self.ids_to_update.popleft()
+            with timed('extract'):
+                self.get_data(pg_config.sql_get_film, params=[ids, ])
+            if not self.rows:
+                # Фильм удалён после попадания в очередь (например, из propagate_deletions)
+                continue
+            ROWS_EXTRACTED.inc(len(self.rows))
             yield self.rows
 
+    def pop_next_batch(self):
+        """Денормализация пачки из bulk_factor фильмов одним запросом,
+        отдаёт uuid и updated_at фильмов пачки и плоский список строк по ним
+        """
+        self._drain_queue()
+        while self._refill(pg_config.bulk_factor):
+            size = min(pg_config.bulk_factor, len(self.ids_to_update))
+            chunk = [self.ids_to_update.popleft() for _ in range(size)]
+            with timed('extract'):
+                self.get_data(pg_config.sql_get_films, params=([x[0] for x in chunk],))
+            ROWS_EXTRACTED.inc(len(self.rows))
+            yield chunk, self.rows
+
+    def _pop_next_batch(self):
+        """Строки пачки группируются по uuid фильма и отдаются в порядке стека"""
+        for chunk, rows in self.pop_next_batch():
+            films = defaultdict(list)
+            for row in rows:
+                films[row[0]].append(row)
+            for ids, updated_at in chunk:
+                if ids in films:
+                    yield films.pop(ids)
+
+    def _enqueue(self, rows):
+        """Добавить в очередь цикла пары (uuid, updated_at); повторный фильм оставляет больший updated_at"""
+        for film_id, updated_at in rows:
+            known = self.work_queue.get(film_id)
+            if film_id not in self.work_queue or (updated_at is not None and (known is None or updated_at > known)):
+                self.work_queue[film_id] = updated_at
+
+    def _drain_queue(self):
+        """Переложить очередь цикла в стек обработки. Контрольные точки очереди записывает commit_queue"""
+        if self.work_queue:
+            self.ids_to_update.extend(self.work_queue.items())
+            self.seen.update(self.work_queue)
+            self.work_queue = {}
+
+    def _refill(self, size: int) -> bool:
+        """Дочитать потоки fan-out, пока в стеке меньше size фильмов; фильмы, уже обработанные в цикле,
+        пропускаются. Отдаёт, остались ли фильмы в стеке
+        """
+        while len(self.ids_to_update) < size and self.fanout:
+            rows = next(self.fanout[0], None)
+            if rows is None:
+                self.fanout.popleft()
+                continue
+            for film_id, updated_at in rows:
+                if film_id not in self.seen:
+                    self.seen.add(film_id)
+                    self.ids_to_update.append((film_id, updated_at))
+        return bool(self.ids_to_update)
+
+    def defer_checkpoint(self, source: str, last_time, last_id):
+        """Отложить запись ключа (updated_at, id) источника до подтверждения фильмов очереди"""
+        self.checkpoints[source] = last_time
+        self.checkpoints[f'{source}_id'] = last_id
+
+    def commit_queue(self):
+        """Записать контрольные точки источников, фильмы которых из очереди цикла подтверждены ES"""
+        for key, value in self.checkpoints.items():
+            self.state.set_state(key, value)
+        self.checkpoints = {}
+        if self.tombstones:
+            self.get_data(pg_config.sql_delete_tombstones, params=(self.tombstones,))
+            self.tombstones = []
+        self.seen = set()
+
+    def _push_ids(self, execute: str, params):
+        """Поместить в очередь цикла uuid фильмов: целиком или ленивым потоком именованного курсора,
+        который читается пачками по мере обработки очереди (память не растёт с размером fan-out)
+        """
+        if pg_config.stream_fanout:
+            self.fanout.append(self.stream_data(execute, params=params))
+        else:
+            self.get_data(execute, params=params)
+            self._enqueue(self.rows)
+
     def _push_persons(self):
-        """Выбрать UUID фильмов затронутых изменением person и поместить их в стек обработки"""
+        """Выбрать UUID фильмов затронутых изменением person и поместить их в очередь цикла"""
 
-        last_time = self.rows[-1][1]
+        last_id, last_time = self.rows[-1][0], self.rows[-1][1]
         person_ids = tuple([x[0] for x in self.rows])
-        self.get_data(pg_config.sql_push_persons, params=(person_ids,))
-        self.ids_to_update = self.rows
-        self.state.set_state('p', last_time)
+        self._push_ids(pg_config.sql_push_persons, params=(person_ids,))
+        self.defer_checkpoint('p', last_time, last_id)
 
     def _push_genres(self):
-        """Выбрать UUID фильмов затронутых изменением genres и поместить их в стек обработки"""
+        """Выбрать UUID фильмов затронутых изменением genres и поместить их в очередь цикла"""
 
-        last_time = self.rows[-1][1]
+        last_id, last_time = self.rows[-1][0], self.rows[-1][1]
         genres_ids = tuple([x[0] for x in self.rows])
-        self.get_data(pg_config.sql_push_genres, params=(genres_ids,))
-        self.ids_to_update = self.rows
-        self.state.set_state('g', last_time)
+        self._push_ids(pg_config.sql_push_genres, params=(genres_ids,))
+        self.defer_checkpoint('g', last_time, last_id)
+
+    def get_films_of(self, source: str, ids: list) -> list:
+        """UUID фильмов, в которых участвуют персоны (source p) или жанры (source g) ids"""
+        execute = pg_config.sql_push_persons if source == 'p' else pg_config.sql_push_genres
+        films = []
+        for rows in self.stream_data(execute, params=(tuple(ids),)):
+            films.extend(row[0] for row in rows)
+        return films
+
+    def range_checksum(self, after: str, last: str) -> tuple:
+        """Число фильмов диапазона uuid (after, last] и суммы первых 32 бит uuid и updated_at в секундах"""
+        self.get_data(pg_config.sql_audit_checksum, params=(after, last))
+        return tuple(int(x) for x in self.rows[0])
+
+    def range_ids(self, after: str, last: str) -> dict:
+        """uuid -> updated_at (в iso формате, как в документе ES) фильмов диапазона (after, last]"""
+        ids = {}
+        while True:
+            self.get_data(pg_config.sql_get_partition_ids, params=(after, last, pg_config.bulk_factor))
+            if not self.rows:
+                return ids
+            for film_id, updated_at in self.rows:
+                ids[film_id] = None if updated_at is None else updated_at.isoformat()
+            after = self.rows[-1][0]
+
+    def prepare_tombstones(self):
+        """Создать таблицу content.etl_tombstone и триггеры удаления, если их нет (база старше init.sql с ними)"""
+        self._check_connection()
+        with self.connection.cursor() as cursor:
+            cursor.execute(TOMBSTONE_DDL)
 
-    def check_persons_updates(self):
-        """Получение списка uuid и updated_at из таблицы person если были изменения
+    def prepare_change_feed(self):
+        """Создать функцию уведомлений на канал app.notify_channel и триггеры таблиц content.*, если их нет"""
+        self._check_connection()
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql.SQL(NOTIFY_DDL).format(channel=sql.Literal(app_config.notify_channel)))
+
+    def get_tombstones(self) -> list:
+        """Страница записей об удалённых строках (id, deleted_at, table_name, row_id, film_work_id).
+        Записи не читаются по ключу id (транзакции фиксируются не в порядке bigserial), а удаляются из таблицы
+        в commit_queue, после подтверждения очереди цикла. Контрольная точка del - только для отставания
         """
+        self.get_data(pg_config.sql_get_tombstones, params=(pg_config.bulk_factor,))
+        if self.rows:
+            self.tombstones.extend(row[0] for row in self.rows)
+            self.defer_checkpoint('del', self.rows[-1][1], self.rows[-1][0])
+        return self.rows
+
+    def push_films(self, ids: list):
+        """Поместить в очередь цикла заданные uuid фильмов"""
+        self._enqueue((film_id, None) for film_id in ids)
+
+    def commit_checkpoint(self, source: str, rows: list):
+        """Записать в состояние источника (p или g) ключ (updated_at, id) последней строки страницы"""
+        last_id, last_time = rows[-1][0], rows[-1][1]
+        self.state.set_state(source, last_time)
+        self.state.set_state(f'{source}_id', last_id)
+
+    def get_changed_persons(self) -> list:
+        """Страница изменённых персон (uuid, updated_at, full_name) после контрольной точки p"""
         persons_last_time = self.state.get_state('p')
-        self.get_data(pg_config.sql_check_persons, params=(persons_last_time,))
-        if len(self.rows) != 0:
-            self._push_persons()
-        self.not_complete['p'] = len(self.rows) != 0
+        persons_last_id = self.state.get_state('p_id') or ZERO_UUID
+        self.get_data(
+            pg_config.sql_check_persons, params=(persons_last_time, persons_last_id, pg_config.bulk_factor)
+        )
+        return self.rows
 
-    def check_genres_updates(self):
-        """Получение списка uuid и updated_at из таблицы genre если были изменения
-        """
+    def get_changed_genres(self) -> list:
+        """Страница изменённых жанров (uuid, updated_at, name) после контрольной точки g"""
         genres_last_time = self.state.get_state('g')
-        self.get_data(pg_config.sql_check_genres, params=(genres_last_time,))
+        genres_last_id = self.state.get_state('g_id') or ZERO_UUID
+        self.get_data(
+            pg_config.sql_check_genres, params=(genres_last_time, genres_last_id, pg_config.bulk_factor)
+        )
+        return self.rows
 
-        if len(self.rows) != 0:
+    def check_persons_updates(self) -> int:
+        """Получение страницы uuid и updated_at из таблицы person если были изменения,
+        отдаёт число изменённых персон
+        """
+        count = len(self.get_changed_persons())
+        if count != 0:
+            self._push_persons()
+        return count
+
+    def check_genres_updates(self) -> int:
+        """Получение страницы uuid и updated_at из таблицы genre если были изменения,
+        отдаёт число изменённых жанров
+        """
+        count = len(self.get_changed_genres())
+        if count != 0:
             self._push_genres()
-        self.not_complete['g'] = len(self.rows) != 0
+        return count
 
     def __del__(self):
-        self.connection.close()
\ No newline at end of file
+        self.cursor.close()
+        release_pg_connection(self.connection)
\ No newline at end of file
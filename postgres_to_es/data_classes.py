@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel
 
@@ -9,8 +9,39 @@ class AppSettings(BaseModel):
     backoff_start_sleep_time: float
     backoff_factor: int
     backoff_border_sleep_time: int
+    change_feed: bool
+    notify_channel: str
+    notify_debounce: float
     await_time: float
+    poll_min_interval: float
+    poll_max_interval: float
+    poll_backoff_factor: float
+    async_pipeline: bool
+    async_queue_size: int
+    batch_transform: bool
+    partial_updates: bool
+    deletions: bool
+    audit_ranges: int
+    audit_fanout: int
+    audit_leaf_size: int
+    state_backend: Literal['json', 'sqlite', 'postgres']
     storage_file_path: str
+    side_storage_file_path: str
+    state_sqlite_path: str
+    state_table: str
+    dead_letter_file_path: str
+    reindex_storage_file_path: str
+    fingerprints: bool
+    fingerprint_sqlite_path: str
+    state_flush_policy: Literal['always', 'every_n', 'timer']
+    state_flush_every: int
+    state_flush_interval: float
+    metrics: bool
+    metrics_port: int
+    metrics_textfile: str
+    profile: bool
+    profile_dir: str
+    profile_request_file: str
     log_file_path: str
     log_maxBytes: int
     log_backupCount: int
@@ -23,6 +54,10 @@ class ESSettings(BaseModel):
     genre_index: str
     person_index: str
     bulk_factor: int
+    inflight_bulk: int
+    bulk_max_bytes: int
+    forcemerge_timeout: int
+    partial_update_timeout: int
     default_scheme_file: str
     genres_scheme_file: str
     persons_scheme_file: str
@@ -35,21 +70,34 @@ class PGSettings(BaseModel):
     DB_HOST: str
     DB_PORT: int
     options: str
+    pool_size: int
     bulk_factor: int
+    batch_extract: bool
+    stream_fanout: bool
+    stream_chunk_size: int
     sql_get_top_time_person: str
     sql_get_top_time_genre: str
     sql_check_persons: str
     sql_push_persons: str
     sql_push_genres: str
     sql_check_genres: str
+    sql_side_persons: str
+    sql_side_genres: str
+    sql_audit_checksum: str
+    sql_get_tombstones: str
+    sql_delete_tombstones: str
     sql_get_new_ids: str
+    sql_get_partition_ids: str
+    sql_get_changed_since: str
     sql_get_film: str
+    sql_get_films: str
 
 
 @dataclass
 class MovieRaw:
     __slots__ = (
-        'uuid', 'title', 'description', 'imdb_rating', 'role', 'person_id', 'person_name', 'genre', 'genre_id'
+        'uuid', 'title', 'description', 'imdb_rating', 'role', 'person_id', 'person_name', 'genre', 'genre_id',
+        'updated_at'
     )
     uuid: str
     title: str
@@ -60,6 +108,7 @@ class MovieRaw:
     person_name: str
     genre: str
     genre_id: str
+    updated_at: Optional[datetime]
 
 
 @dataclass
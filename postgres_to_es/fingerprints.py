@@ -0,0 +1,63 @@
+import hashlib
+import sqlite3
+
+from config import app_config
+from logger import log
+from profiling import traced
+
+log = log.getChild(__name__)
+
+
+def fingerprint(line: bytes) -> str:
+    """Хеш готовой строки bulk запроса (заголовок и документ)"""
+    return hashlib.blake2b(line, digest_size=16).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Хеши документов, подтверждённых ES, в локальном файле SQLite.
+    Документ, хеш которого совпадает с сохранённым, повторно в ES не отправляется
+    """
+
+    def __init__(self, db_path=app_config.fingerprint_sqlite_path):
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints ('
+                'es_index TEXT NOT NULL, id TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (es_index, id))'
+            )
+
+    @traced('fingerprints.lookup')
+    def is_unchanged(self, index: str, uuid: str, digest: str) -> bool:
+        row = self.connection.execute(
+            'SELECT digest FROM fingerprints WHERE es_index = ? AND id = ?', (index, str(uuid))
+        ).fetchone()
+        return row is not None and row[0] == digest
+
+    def save(self, index: str, items: list):
+        """Запомнить хеши подтверждённых документов, items - пары (uuid, digest)"""
+        if not items:
+            return
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO fingerprints (es_index, id, digest) VALUES (?, ?, ?) '
+                'ON CONFLICT (es_index, id) DO UPDATE SET digest = excluded.digest',
+                [(index, str(uuid), digest) for uuid, digest in items]
+            )
+
+    def forget_ids(self, index: str, ids: list):
+        """Забыть хеши документов ids, изменённых в ES в обход пачек (частичные обновления)"""
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM fingerprints WHERE es_index = ? AND id = ?', [(index, str(uuid)) for uuid in ids]
+            )
+
+    def forget(self, index: str):
+        """Забыть все хеши индекса, например после его пересоздания"""
+        with self.connection:
+            self.connection.execute('DELETE FROM fingerprints WHERE es_index = ?', (index,))
+        log.info(f'Fingerprints of index:{index} are cleared')
+
+
+if __name__ == '__main__':
+    pass
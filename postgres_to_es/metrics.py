@@ -0,0 +1,86 @@
+import time
+from contextlib import contextmanager
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+from config import app_config
+from logger import log
+
+log = log.getChild(__name__)
+
+# Границы гистограмм длительности стадий в секундах
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+ENABLED = app_config.metrics and prometheus_client is not None
+REGISTRY = prometheus_client.CollectorRegistry() if ENABLED else None
+
+
+class _Noop:
+    """Заглушка метрики, когда метрики выключены или prometheus_client не установлен"""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _metric(kind: str, name: str, documentation: str, labels: tuple = (), **kwargs):
+    if not ENABLED:
+        return _Noop()
+    return getattr(prometheus_client, kind)(name, documentation, labels, registry=REGISTRY, **kwargs)
+
+
+ROWS_EXTRACTED = _metric('Counter', 'etl_rows_extracted', 'Строки денормализованных данных фильмов из Postgres')
+DOCS_TRANSFORMED = _metric('Counter', 'etl_documents_transformed', 'Документы фильмов после трансформации')
+DOCS_SKIPPED = _metric('Counter', 'etl_documents_unchanged', 'Документы, не отправленные в ES: хеш не изменился')
+BULK_DOCS = _metric('Counter', 'etl_bulk_documents', 'Действия bulk запросов, подтверждённые ES', ('index',))
+BULK_BYTES = _metric('Counter', 'etl_bulk_bytes', 'Байты тел bulk запросов', ('index',))
+BULK_ERRORS = _metric('Counter', 'etl_bulk_item_errors', 'Ошибки отдельных действий bulk', ('index', 'status'))
+STAGE_SECONDS = _metric(
+    'Histogram', 'etl_stage_seconds', 'Длительность стадий extract, transform и load', ('stage',),
+    buckets=STAGE_BUCKETS
+)
+LAG_SECONDS = _metric('Gauge', 'etl_replication_lag_seconds', 'Текущее время минус контрольная точка', ('source',))
+POLL_INTERVAL = _metric('Gauge', 'etl_poll_interval_seconds', 'Интервал опроса источника', ('source',))
+
+
+@contextmanager
+def timed(stage: str):
+    """Записать длительность блока в гистограмму стадии stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def start():
+    """Отдавать метрики по HTTP на app_config.metrics_port (0 - не отдавать)"""
+    if not app_config.metrics:
+        return
+    if prometheus_client is None:
+        log.warning('prometheus_client is not installed, metrics are disabled')
+        return
+    if app_config.metrics_port:
+        prometheus_client.start_http_server(app_config.metrics_port, registry=REGISTRY)
+        log.info(f'Metrics are served on port {app_config.metrics_port}')
+
+
+def export():
+    """Записать метрики в app_config.metrics_textfile для textfile collector node_exporter (пусто - не писать)"""
+    if ENABLED and app_config.metrics_textfile:
+        prometheus_client.write_to_textfile(app_config.metrics_textfile, REGISTRY)
+
+
+if __name__ == '__main__':
+    pass
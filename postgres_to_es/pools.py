@@ -0,0 +1,77 @@
+import os
+import threading
+
+from elasticsearch import Elasticsearch
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from backoff_decorator import backoff
+from config import pg_config, es_config, dsl
+from logger import log
+
+log = log.getChild(__name__)
+
+# Пулы и клиенты живут в пределах процесса: дочерние процессы (reindex.py) создают свои,
+# а не пользуются унаследованными сокетами родителя
+_pg_pools = {}
+_es_clients = {}
+_lock = threading.Lock()
+
+
+def pg_pool() -> ThreadedConnectionPool:
+    """Общий для процесса пул соединений Postgres, до pg_config.pool_size соединений"""
+    pid = os.getpid()
+    with _lock:
+        if pid not in _pg_pools:
+            _pg_pools[pid] = ThreadedConnectionPool(1, pg_config.pool_size, **dsl, cursor_factory=DictCursor)
+        return _pg_pools[pid]
+
+
+def get_pg_connection():
+    """Соединение из пула, закрытое соединение пулом не отдаётся"""
+    pool = pg_pool()
+    connection = pool.getconn()
+    if connection.closed:
+        pool.putconn(connection, close=True)
+        connection = pool.getconn()
+    return connection
+
+
+def check_pg_connection(connection):
+    """Проверка соединения перед запросом без обращения к серверу: закрытое после сбоя
+    соединение заменяется новым из пула, прерванная ошибкой транзакция откатывается
+    """
+    if connection.closed:
+        log.warning('Postgres connection is closed, reconnect')
+        pg_pool().putconn(connection, close=True)
+        return get_pg_connection()
+    if connection.get_transaction_status() == TRANSACTION_STATUS_INERROR:
+        connection.rollback()
+    return connection
+
+
+def release_pg_connection(connection):
+    """Вернуть соединение в пул: открытая транзакция откатывается, autocommit выключается"""
+    if not connection.closed:
+        connection.rollback()
+        connection.autocommit = False
+    pg_pool().putconn(connection, close=bool(connection.closed))
+
+
+@backoff(logy=log.getChild('es_client'))
+def es_client() -> Elasticsearch:
+    """Общий для процесса клиент ES: один транспорт с пулом keep-alive соединений.
+    Готовность кластера проверяется один раз, при создании клиента
+    """
+    pid = os.getpid()
+    with _lock:
+        if pid not in _es_clients:
+            client = Elasticsearch(host=es_config.ES_URL, maxsize=max(es_config.inflight_bulk, 10))
+            client.cluster.health(wait_for_status='yellow', request_timeout=1)
+            _es_clients[pid] = client
+        return _es_clients[pid]
+
+
+if __name__ == '__main__':
+    pass
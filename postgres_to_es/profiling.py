@@ -0,0 +1,156 @@
+import cProfile
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime as dt
+from functools import wraps
+
+from config import app_config
+from logger import log
+
+log = log.getChild(__name__)
+
+# Цикл обновления, который сейчас профилируется (None - стадии не измеряются)
+_cycle = None
+_dump_requested = False
+
+
+class _CycleTrace:
+    """Время стадий одного цикла: сводка по стадиям и спаны каждого вызова"""
+
+    def __init__(self, dump: bool):
+        self.trace_id = uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.started_ns = time.time_ns()
+        self.started = time.perf_counter()
+        self.dump = dump
+        self.stats = defaultdict(lambda: [0, 0.0, 0.0])
+        self.spans = []
+        self.lock = threading.Lock()
+        self.profiler = cProfile.Profile() if dump else None
+
+    def record(self, name: str, started_ns: int, wall: float, cpu: float, attributes: dict):
+        with self.lock:
+            stat = self.stats[name]
+            stat[0] += 1
+            stat[1] += wall
+            stat[2] += cpu
+            if self.dump:
+                self.spans.append({
+                    'trace_id': self.trace_id,
+                    'span_id': uuid.uuid4().hex[:16],
+                    'parent_span_id': self.span_id,
+                    'name': name,
+                    'start_time_unix_nano': started_ns,
+                    'end_time_unix_nano': started_ns + int(wall * 1e9),
+                    'attributes': {'cpu_seconds': cpu, 'thread': threading.current_thread().name, **attributes},
+                })
+
+
+def request_dump(*args):
+    """Снять cProfile и спаны следующего цикла (обработчик SIGUSR1)"""
+    global _dump_requested
+    _dump_requested = True
+
+
+def install():
+    """Снимок цикла по запросу: kill -USR1 <pid> или файл app_config.profile_request_file"""
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, request_dump)
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """Измерить стенное и процессорное (потока) время блока как стадию name текущего цикла"""
+    trace = _cycle
+    if trace is None:
+        yield
+        return
+    started_ns = time.time_ns()
+    started, started_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        trace.record(name, started_ns, time.perf_counter() - started, time.thread_time() - started_cpu, attributes)
+
+
+def traced(name: str):
+    """Декоратор: каждый вызов функции - стадия name текущего цикла"""
+
+    def my_decorator(f):
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if _cycle is None:
+                return f(*args, **kwargs)
+            with stage(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return my_decorator
+
+
+@contextmanager
+def cycle():
+    """Профилирование одного цикла обновления.
+    С app_config.profile в лог пишется сводка по стадиям каждого цикла,
+    по запросу (install) цикл дополнительно снимается cProfile (только поток цикла)
+    и спанами всех потоков в app_config.profile_dir. Отдаёт трассу цикла (None, если профилирование выключено)
+    """
+    global _cycle, _dump_requested
+    dump = _dump_requested or os.path.exists(app_config.profile_request_file)
+    if not (app_config.profile or dump):
+        yield None
+        return
+    trace = _CycleTrace(dump)
+    _cycle = trace
+    if trace.profiler is not None:
+        trace.profiler.enable()
+    try:
+        yield trace
+    finally:
+        if trace.profiler is not None:
+            trace.profiler.disable()
+        _cycle = None
+        _log_summary(trace)
+        if dump:
+            _dump_requested = False
+            if os.path.exists(app_config.profile_request_file):
+                os.unlink(app_config.profile_request_file)
+            _dump(trace)
+
+
+def _log_summary(trace: _CycleTrace):
+    total = time.perf_counter() - trace.started
+    parts = [
+        f'{name} {calls}x {wall:.3f}s wall {cpu:.3f}s cpu'
+        for name, (calls, wall, cpu) in sorted(trace.stats.items(), key=lambda item: -item[1][1])
+    ]
+    log.info(f'Cycle took {total:.3f}s: {"; ".join(parts) or "no stages"}')
+
+
+def _dump(trace: _CycleTrace):
+    os.makedirs(app_config.profile_dir, exist_ok=True)
+    prefix = os.path.join(app_config.profile_dir, f'cycle_{dt.now().strftime("%Y%m%d_%H%M%S")}')
+    trace.profiler.dump_stats(f'{prefix}.pstats')
+    with open(f'{prefix}.spans.jsonl', 'w') as f:
+        f.write(json.dumps({
+            'trace_id': trace.trace_id,
+            'span_id': trace.span_id,
+            'name': 'cycle',
+            'start_time_unix_nano': trace.started_ns,
+            'end_time_unix_nano': trace.started_ns + int((time.perf_counter() - trace.started) * 1e9),
+        }) + '\n')
+        for span in trace.spans:
+            f.write(json.dumps(span, default=str) + '\n')
+    log.info(f'Cycle profile saved to {prefix}.pstats and {prefix}.spans.jsonl')
+
+
+if __name__ == '__main__':
+    pass
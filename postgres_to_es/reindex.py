@@ -0,0 +1,128 @@
+import argparse
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from config import app_config, es_config, movies_index
+from connectors import ESConnector, PGConnector
+from fingerprints import FingerprintStore
+from logger import log
+from storage import State, get_storage
+from updater import update
+
+log = log.getChild(__name__)
+
+UUID_SPACE = 2 ** 128
+
+
+def partition_bounds(partition: int, workers: int) -> tuple:
+    """
+    Границы (after, last] партиции пространства UUID для фильмов.
+    Нижняя граница не включается, поэтому это последний uuid предыдущей партиции
+    (для первой партиции - нулевой uuid, который uuid4 не выдаёт)
+    """
+    after = max(UUID_SPACE * partition // workers - 1, 0)
+    last = UUID_SPACE * (partition + 1) // workers - 1
+    return str(uuid.UUID(int=after)), str(uuid.UUID(int=last))
+
+
+def reindex_partition(partition: int, workers: int, fresh: bool = False, index: str = movies_index) -> int:
+    """Извлечь, трансформировать и загрузить в ES все фильмы одной партиции, отдаёт число фильмов.
+    Прогресс (последний uuid) хранится в State партиции, повторный запуск продолжает с него
+    """
+    after, last = partition_bounds(partition, workers)
+    state = State(get_storage(app_config.reindex_storage_file_path.format(partition=partition, workers=workers)))
+    if fresh:
+        state.set_state('last_id', None)
+        state.set_state('done', False)
+    if state.get_state('done'):
+        log.info(f'Partition {partition} of {workers} is already reindexed')
+        return 0
+
+    pg = PGConnector()
+    es = ESConnector()
+    es.index = index
+    es.fingerprints = None
+    after = state.get_state('last_id') or after
+    count = 0
+    while True:
+        pg.get_partition_ids(after, last)
+        if not pg.ids_to_update:
+            break
+        after = pg.ids_to_update[-1][0]
+        count += len(pg.ids_to_update)
+        update(pg=pg, es=es)
+        state.set_state('last_id', after)
+        log.info(f'Partition {partition} of {workers}: {count} films reindexed')
+
+    state.set_state('done', True)
+    state.flush()
+    return count
+
+
+def pg_now(pg: PGConnector):
+    """Текущее время по часам Postgres"""
+    pg.get_data('SELECT now();')
+    return pg.rows[0][0]
+
+
+def catch_up(index: str, since):
+    """Догрузить в index фильмы, изменённые после since, отдаёт время начала догрузки"""
+    pg = PGConnector()
+    es = ESConnector()
+    es.index = index
+    es.fingerprints = None
+    started = pg_now(pg)
+    pg.push_changed_since(since)
+    update(pg=pg, es=es)
+    return started
+
+
+def reindex(workers: int, fresh: bool = False, new_index: bool = False, drop_old: bool = False):
+    """Полная переиндексация movies: пространство uuid делится на workers партиций,
+    каждую обрабатывает отдельный процесс.
+    С new_index заливка идёт в новую версию индекса (movies_vN) без обновления поиска и реплик,
+    затем догружаются изменения за время заливки, индексу возвращаются настройки, сегменты сливаются
+    и alias movies атомарно переключается на новую версию - поиск не простаивает
+    """
+    es = ESConnector()
+    es.prepare_indexes()
+    if app_config.fingerprints:
+        FingerprintStore().forget(movies_index)
+    index = movies_index
+    if new_index:
+        fresh = True
+        index = es.create_versioned_index(movies_index, es_config.default_scheme_file)
+        started = pg_now(PGConnector())
+        log.info(f'Reindex into new index:{index}')
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(reindex_partition, partition, workers, fresh, index) for partition in range(workers)
+        ]
+        total = sum(future.result() for future in futures)
+    log.info(f'Reindex finished: {total} films in {workers} partitions')
+
+    if new_index:
+        started = catch_up(index, started)
+        es.finish_versioned_index(index, es_config.default_scheme_file)
+        old = es.swap_alias(movies_index, index)
+        log.info(f'Alias {movies_index} switched to {index} from {old}')
+        catch_up(movies_index, started)
+        if drop_old:
+            for name in old:
+                if name != movies_index:
+                    es.connection.indices.delete(index=name)
+                    log.info(f'Old index:{name} deleted')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Полная переиндексация фильмов в несколько процессов')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='число процессов и партиций')
+    parser.add_argument('--fresh', action='store_true', help='начать заново, не продолжая сохранённый прогресс')
+    parser.add_argument(
+        '--new-index', action='store_true', help='залить новую версию индекса и переключить на неё alias'
+    )
+    parser.add_argument('--drop-old', action='store_true', help='удалить прежнюю версию индекса после переключения')
+    args = parser.parse_args()
+    reindex(args.workers, args.fresh, args.new_index, args.drop_old)
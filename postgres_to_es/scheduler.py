@@ -0,0 +1,97 @@
+import time
+from datetime import datetime as dt, timezone
+from typing import Dict, Iterable, Optional
+
+from config import app_config
+from logger import log
+from metrics import LAG_SECONDS, POLL_INTERVAL
+
+log = log.getChild(__name__)
+
+# Какие источники будить по уведомлению об изменении таблицы (change_feed)
+TABLE_SOURCES = {
+    'film_work': ('fw', 'del'),
+    'person': ('p', 'side', 'del'),
+    'genre': ('g', 'side', 'del'),
+    'person_film_work': ('fw', 'del'),
+    'genre_film_work': ('fw', 'del'),
+}
+
+
+class SourceSchedule:
+    """Интервал опроса одного источника и отставание его контрольной точки"""
+    __slots__ = ('name', 'interval', 'next_at', 'lag', 'rows')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.interval = app_config.await_time
+        self.next_at = time.monotonic()
+        self.lag = None
+        self.rows = 0
+
+
+class PollScheduler:
+    """
+    Адаптивный опрос источников (fw - фильмы, p - персоны, g - жанры, side - индексы жанров и персон,
+    del - удалённые строки).
+    Пока источник отдаёт полные пачки, он опрашивается сразу (poll_min_interval),
+    неполная пачка сокращает интервал вдвое, пустая - увеличивает его в poll_backoff_factor раз
+    до poll_max_interval
+    """
+
+    def __init__(self, sources: Iterable[str] = ('fw', 'p', 'g', 'side', 'del')):
+        self.sources: Dict[str, SourceSchedule] = {name: SourceSchedule(name) for name in sources}
+
+    def due(self) -> list:
+        """Источники, которые пора опросить"""
+        now = time.monotonic()
+        return [name for name, source in self.sources.items() if source.next_at <= now]
+
+    def record(self, name: str, rows: int, full: bool, checkpoint: Optional[str] = None):
+        """Учесть результат опроса источника и назначить следующий"""
+        source = self.sources[name]
+        source.rows = rows
+        if full:
+            source.interval = app_config.poll_min_interval
+        elif rows:
+            source.interval = max(source.interval / 2, app_config.poll_min_interval)
+        else:
+            source.interval = min(
+                max(source.interval, app_config.await_time) * app_config.poll_backoff_factor,
+                app_config.poll_max_interval
+            )
+        source.next_at = time.monotonic() + source.interval
+        POLL_INTERVAL.labels(name).set(source.interval)
+        if checkpoint:
+            source.lag = (dt.now(timezone.utc) - dt.fromisoformat(str(checkpoint))).total_seconds()
+            LAG_SECONDS.labels(name).set(source.lag)
+
+    def wake(self, tables: Iterable[str]):
+        """Опросить сразу источники, затронутые изменёнными таблицами (неизвестная таблица будит все)"""
+        now = time.monotonic()
+        for table in tables:
+            for name in TABLE_SOURCES.get(table, self.sources):
+                if name in self.sources:
+                    self.sources[name].next_at = now
+
+    def next_wait(self) -> float:
+        """Сколько секунд до ближайшего опроса"""
+        return max(min(source.next_at for source in self.sources.values()) - time.monotonic(), 0)
+
+    def stats(self) -> dict:
+        """Текущий интервал (сек), отставание контрольной точки (сек) и размер последней пачки по источникам"""
+        return {
+            name: {'interval': source.interval, 'lag': source.lag, 'rows': source.rows}
+            for name, source in self.sources.items()
+        }
+
+    def log_stats(self):
+        parts = []
+        for name, source in self.sources.items():
+            lag = '-' if source.lag is None else f'{source.lag:.0f}s'
+            parts.append(f'{name} every {source.interval:.1f}s, lag {lag}')
+        log.info(f'Poll schedule: {"; ".join(parts)}')
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,50 @@
+import json
+from functools import lru_cache
+
+from profiling import traced
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    def dumps(obj) -> bytes:
+        """JSON документа сразу в байтах"""
+        return orjson.dumps(obj)
+else:
+    def dumps(obj) -> bytes:
+        """JSON документа сразу в байтах (orjson не установлен, стандартный json)"""
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+
+@lru_cache(maxsize=None)
+def _action_header(action: str, index: str) -> bytes:
+    """Неизменная для индекса часть заголовка bulk действия, до значения _id"""
+    return b'{"' + action.encode() + b'":{"_index":' + dumps(index) + b',"_id":'
+
+
+@traced('serialize')
+def index_action(index: str, doc: dict, uuid: str) -> bytes:
+    """Строки bulk запроса ES в формате NDJSON: заголовок index и сам документ"""
+    return _action_header('index', index) + dumps(str(uuid)) + b'}}\n' + dumps(doc) + b'\n'
+
+
+def delete_action(index: str, uuid: str) -> bytes:
+    """Строка bulk запроса ES для удаления документа, у delete нет строки документа"""
+    return _action_header('delete', index) + dumps(str(uuid)) + b'}}\n'
+
+
+def action_id(line: bytes) -> str:
+    """_id документа по строкам bulk действия"""
+    header = json.loads(line[:line.index(b'\n')])
+    return next(iter(header.values()))['_id']
+
+
+def bulk_body(block: list) -> bytes:
+    """Тело bulk запроса из готовых строк, транспорт ES отправляет байты без перекодирования"""
+    return b''.join(block)
+
+
+if __name__ == '__main__':
+    pass
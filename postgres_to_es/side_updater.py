@@ -1,13 +1,15 @@
 import datetime
 import json
 import time
+from collections import deque
 from datetime import datetime as dt
+from functools import lru_cache
 
-from config import es_config, app_config, genre_index, person_index
+from config import es_config, app_config, pg_config, genre_index, person_index
 from logger import log
-from backoff_decorator import backoff
-from connectors import ESConnector, PGConnector
-from storage import State, JsonFileStorage
+from connectors import ESConnector, PGConnector, ZERO_UUID, send_bulk
+from serializer import index_action
+from storage import State, get_storage
 from transform import genres_transformer, person_transformer
 
 log = log.getChild(__name__)
@@ -17,42 +19,37 @@ class SideESConnector(ESConnector):
     def __init__(self):
         super().__init__()
         self.genres_to_es = []
-        self.state = State(JsonFileStorage(file_path='misc/side.json'))
+        self.state = State(get_storage(app_config.side_storage_file_path))
         self.block = []
         self.last_time = None
+        self.last_id = None
 
-    @backoff()
     def upload(self, index):
-
+        """Отправить страницу в ES и сдвинуть контрольную точку (updated_at, id) индекса на её последнюю строку"""
         if not self.block:
             return
-        body = '\n'.join(self.block)
-        res = self.connection.bulk(body=body, index=index, params={'filter_path': 'items.*.error'})
-        if not res:
-            log.info(f'Add block to index:{index} of {len(self.block)} records')
-            self.block.clear()
-            self.state.set_state(index, self.last_time)
-        else:
-            print(res)
-            exit()
+        send_bulk(self.connection, self.block, index)
+        self.block = []
+        self.state.set_state(index, self.last_time)
+        self.state.set_state(f'{index}_id', self.last_id)
 
     def add_to_block_genres(self, doc: dict, uuid: str):
-        index_row = {"index": {"_index": genre_index, "_id": f"{uuid}"}}
-        self.block.append(json.dumps(index_row) + '\n' + json.dumps(doc))
+        self.block.append(index_action(genre_index, doc, uuid))
 
     def add_to_block_person(self, doc: dict, uuid: str):
-        index_row = {"index": {"_index": person_index, "_id": f"{uuid}"}}
-        self.block.append(json.dumps(index_row) + '\n' + json.dumps(doc))
+        self.block.append(index_action(person_index, doc, uuid))
 
 
 class SidePGConnector(PGConnector):
     def __init__(self):
         super().__init__()
-        self.state = State(JsonFileStorage(file_path='misc/side.json'))
-        self.new_genres = []
-        self.new_persons = []
+        self.state = State(get_storage(app_config.side_storage_file_path))
+        self.new_genres = deque()
+        self.new_persons = deque()
         self.last_time_genre = None
         self.last_time_person = None
+        self.last_id_genre = None
+        self.last_id_person = None
 
     def set_start_time(self):
         """
@@ -64,77 +61,92 @@ class SidePGConnector(PGConnector):
         self.last_time_person = dt.fromisoformat('1999-01-01 12:00:00.000001+00:00')
         self.state.set_state(person_index, self.last_time_person)
 
-    def check_persons_updates(self):
-
-        if not self.state.get_state(person_index):
+    def checkpoint(self, index: str) -> tuple:
+        """Контрольная точка (updated_at, id) индекса: последняя строка последней подтверждённой ES страницы"""
+        if not self.state.get_state(index):
             self.set_start_time()
-        self.last_time = dt.fromisoformat(self.state.get_state(person_index))
-        person_last_time = self.state.get_state(person_index)
-        data = '''SELECT id, full_name, birth_date, updated_at 
-        FROM content.person 
-        WHERE updated_at > %s 
-        order by updated_at'''
+        return self.state.get_state(index), self.state.get_state(f'{index}_id') or ZERO_UUID
 
-        self.get_data(data, params=(person_last_time,))
-        self.new_persons = self.rows
-
-    def check_genres_updates(self):
-
-        if not self.state.get_state(genre_index):
-            self.set_start_time()
-        self.last_time = dt.fromisoformat(self.state.get_state(genre_index))
-        genres_last_time = self.state.get_state(genre_index)
-        data = '''SELECT id, name, description, updated_at 
-        FROM content.genre 
-        WHERE updated_at > %s 
-        order by updated_at'''
+    def check_persons_updates(self) -> int:
+        """Следующая страница изменённых персон (не больше es_config.bulk_factor), отдаёт её размер"""
+        self.get_data(pg_config.sql_side_persons, params=(*self.checkpoint(person_index), es_config.bulk_factor))
+        self.new_persons = deque(self.rows)
+        return len(self.new_persons)
 
-        self.get_data(data, params=(genres_last_time,))
-        self.new_genres = self.rows
+    def check_genres_updates(self) -> int:
+        """Следующая страница изменённых жанров (не больше es_config.bulk_factor), отдаёт её размер"""
+        self.get_data(pg_config.sql_side_genres, params=(*self.checkpoint(genre_index), es_config.bulk_factor))
+        self.new_genres = deque(self.rows)
+        return len(self.new_genres)
 
     def pop_next_to_update_genre(self):
 
         while self.new_genres:
-            ids, name, description, updated_at = self.new_genres.pop(0)
+            ids, name, description, updated_at = self.new_genres.popleft()
             self.last_time_genre = updated_at
+            self.last_id_genre = ids
             yield ids, name, description, updated_at
 
     def pop_next_to_update_person(self):
         while self.new_persons:
-            ids, full_name, birth_date, updated_at = self.new_persons.pop(0)
+            ids, full_name, birth_date, updated_at = self.new_persons.popleft()
             if isinstance(birth_date, datetime.date):
                 birth_date = json.dumps(birth_date, indent=4, sort_keys=True, default=str)[1:-1]
             self.last_time_person = updated_at
+            self.last_id_person = ids
             yield ids, full_name, birth_date, updated_at
 
 
-def genre_updater(pg, es):
-    for data in pg.pop_next_to_update_genre():
-        es.add_to_block_genres(*genres_transformer(data))
-        if len(es.block) >= es_config.bulk_factor:
-            es.last_time = pg.last_time_genre
-            es.upload(genre_index)
-    es.last_time = pg.last_time_genre
-    es.upload(genre_index)
+def genre_updater(pg, es) -> int:
+    """Перенести изменённые жанры в ES постранично, отдаёт их число.
+    В памяти не больше одной страницы, контрольная точка сдвигается после каждой подтверждённой страницы,
+    так что после сбоя перенос продолжается со следующей страницы
+    """
+    count = 0
+    while True:
+        size = pg.check_genres_updates()
+        for data in pg.pop_next_to_update_genre():
+            es.add_to_block_genres(*genres_transformer(data))
+        es.last_time, es.last_id = pg.last_time_genre, pg.last_id_genre
+        es.upload(genre_index)
+        count += size
+        if size < es_config.bulk_factor:
+            return count
+
+
+def person_updater(pg, es) -> int:
+    """Перенести изменённые персоны в ES постранично, отдаёт их число (см. genre_updater)"""
+    count = 0
+    while True:
+        size = pg.check_persons_updates()
+        for data in pg.pop_next_to_update_person():
+            es.add_to_block_person(*person_transformer(data))
+        es.last_time, es.last_id = pg.last_time_person, pg.last_id_person
+        es.upload(person_index)
+        count += size
+        if size < es_config.bulk_factor:
+            return count
+
+
+@lru_cache(maxsize=None)
+def side_connectors() -> tuple:
+    """Коннекторы индексов жанров и персон создаются один раз и переиспользуются в каждом цикле"""
+    return SideESConnector(), SidePGConnector()
+
+
+def side_check() -> int:
+    """Перенести в ES изменённые жанры и персоны, отдаёт их число"""
+    es, pg = side_connectors()
+
+    count = genre_updater(pg=pg, es=es)
+    count += person_updater(pg=pg, es=es)
 
+    log.info(f'Persons and Genres moved to ES, no new data yet...')
+    return count
 
-def person_updater(pg, es):
-    for data in pg.pop_next_to_update_person():
-        es.add_to_block_person(*person_transformer(data))
-        if len(es.block) >= es_config.bulk_factor:
-            es.last_time = pg.last_time_person
-            es.upload(person_index)
-    es.last_time = pg.last_time_person
-    es.upload(person_index)
-
-
-def side_check():
-    es = SideESConnector()
-    pg = SidePGConnector()
-
-    pg.check_genres_updates()
-    genre_updater(pg=pg, es=es)
-    pg.check_persons_updates()
-    person_updater(pg=pg, es=es)
 
-    log.info(f'Persons and Genres moved to ES, no new data yet...')
+def side_checkpoint():
+    """Самая ранняя из контрольных точек индексов жанров и персон"""
+    state = side_connectors()[1].state
+    times = [t for t in (state.get_state(genre_index), state.get_state(person_index)) if t]
+    return min(times, key=dt.fromisoformat) if times else None
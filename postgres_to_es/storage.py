@@ -1,76 +1,264 @@
 import abc
+import atexit
 import json
-from abc import ABC
-from typing import Any
+import os
+import sqlite3
+import tempfile
+import time
+from typing import Any, Dict, Optional
 
+from backoff_decorator import backoff
 from config import app_config
 from logger import log
+from pools import get_pg_connection, release_pg_connection
 
 log = log.getChild(__name__)
 
 
 class BaseStorage:
-    @abc.abstractmethod
-    def check_or_create(self):
-        try:
-            with open(self.file_path, 'r') as f:
-                pass
-        except FileNotFoundError:
-            log.exception(f'Now create file {self.file_path}')
-            with open(self.file_path, 'w') as f:
-                pass
+    # Хранилище общее для нескольких процессов: кеш State перечитывает его при каждом сбросе
+    shared = False
+
+    @property
+    def key(self) -> str:
+        """Ключ хранилища, по нему экземпляры State делят общий кеш"""
+        return f'{type(self).__name__}:{id(self)}'
 
     @abc.abstractmethod
-    def save_state(self, state: dict) -> None:
-        """Сохранить состояние в постоянное хранилище"""
-        self.check_or_create()
-        with open(self.file_path, 'r') as f:
-            file_data = f.read()
-            if not file_data:
-                file_data = state
-            else:
-                file_data = json.loads(file_data)
-                file_data = {**file_data, **state}
-        with open(self.file_path, 'w') as f:
-            f.write(json.dumps(file_data, indent=4, sort_keys=True, default=str))
+    def save_state(self, state: dict, keys: set) -> Optional[dict]:
+        """Сохранить изменённые ключи keys состояния в постоянное хранилище.
+        Общее хранилище отдаёт актуальное состояние с ключами других процессов, остальные - None
+        """
 
     @abc.abstractmethod
-    def retrieve_state(self):
+    def retrieve_state(self) -> dict:
         """Загрузить состояние локально из постоянного хранилища"""
-        self.check_or_create()
-        with open(self.file_path, 'r') as f:
-            file_data = f.read()
-            if not file_data:
-                log.error(f'State file - {self.file_path} is empty')
-                return {}
-            try:
-                return json.loads(file_data)
-            except Exception:
-                log.exception(f'Wrong state file format - {self.file_path}')
-                return
-
-
-class JsonFileStorage(BaseStorage, ABC):
+
+
+class JsonFileStorage(BaseStorage):
     def __init__(self, file_path=app_config.storage_file_path):
         self.file_path = file_path
 
+    @property
+    def key(self) -> str:
+        return os.path.abspath(self.file_path)
+
+    def save_state(self, state: dict, keys: set) -> None:
+        """Атомарно сохранить состояние целиком: временный файл, fsync, rename.
+        При падении процесса на диске остаётся либо старый, либо новый файл целиком
+        """
+        directory = os.path.dirname(self.key)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state_', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(state, indent=4, sort_keys=True, default=str))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def retrieve_state(self) -> dict:
+        try:
+            with open(self.file_path, 'r') as f:
+                file_data = f.read()
+        except FileNotFoundError:
+            log.info(f'State file - {self.file_path} not found, start with empty state')
+            return {}
+        if not file_data:
+            log.error(f'State file - {self.file_path} is empty')
+            return {}
+        try:
+            return json.loads(file_data)
+        except Exception:
+            log.exception(f'Wrong state file format - {self.file_path}')
+            return {}
+
+
+def _namespace(file_path: str) -> str:
+    """Имя пространства ключей состояния по пути к json файлу: misc/side.json -> side"""
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+class SQLiteStorage(BaseStorage):
+    """Состояние в локальном файле SQLite, все пространства ключей в одной таблице"""
+
+    def __init__(self, file_path=app_config.storage_file_path, db_path=app_config.state_sqlite_path):
+        self.namespace = _namespace(file_path)
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path)
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {app_config.state_table} ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (namespace, key))'
+            )
+
+    @property
+    def key(self) -> str:
+        return f'sqlite:{os.path.abspath(self.db_path)}:{self.namespace}'
+
+    def save_state(self, state: dict, keys: set) -> None:
+        rows = [(self.namespace, k, json.dumps(state[k], default=str)) for k in keys]
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT INTO {app_config.state_table} (namespace, key, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value',
+                rows
+            )
+
+    def retrieve_state(self) -> dict:
+        with self.connection:
+            rows = self.connection.execute(
+                f'SELECT key, value FROM {app_config.state_table} WHERE namespace = ?', (self.namespace,)
+            ).fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+
+class PGStorage(BaseStorage):
+    """Состояние в таблице Postgres, общее для нескольких реплик ETL.
+    Каждое сохранение - одна транзакция на соединении, взятом из пула на время операции:
+    advisory lock пространства ключей, upsert только изменённых ключей и чтение актуального состояния,
+    так что реплики не затирают ключи друг друга и видят чужие контрольные точки
+    """
+    shared = True
+
+    @backoff(logy=log.getChild('PGStorage.init'))
+    def __init__(self, file_path=app_config.storage_file_path):
+        self.namespace = _namespace(file_path)
+        connection = get_pg_connection()
+        try:
+            with connection, connection.cursor() as cursor:
+                cursor.execute(
+                    f'CREATE TABLE IF NOT EXISTS {app_config.state_table} ('
+                    'namespace text NOT NULL, key text NOT NULL, value jsonb, PRIMARY KEY (namespace, key))'
+                )
+        finally:
+            release_pg_connection(connection)
+
+    @property
+    def key(self) -> str:
+        return f'postgres:{app_config.state_table}:{self.namespace}'
+
+    @backoff(logy=log.getChild('PGStorage.save_state'))
+    def save_state(self, state: dict, keys: set) -> dict:
+        rows = [(self.namespace, k, json.dumps(state[k], default=str)) for k in keys]
+        connection = get_pg_connection()
+        try:
+            with connection, connection.cursor() as cursor:
+                # Блокировка до конца транзакции: сохранения реплик в одно пространство ключей идут по очереди
+                cursor.execute('SELECT pg_advisory_xact_lock(hashtext(%s))', (self.key,))
+                cursor.executemany(
+                    f'INSERT INTO {app_config.state_table} (namespace, key, value) VALUES (%s, %s, %s) '
+                    'ON CONFLICT (namespace, key) DO UPDATE SET value = EXCLUDED.value',
+                    rows
+                )
+                cursor.execute(
+                    f'SELECT key, value FROM {app_config.state_table} WHERE namespace = %s', (self.namespace,)
+                )
+                return dict(cursor.fetchall())
+        finally:
+            release_pg_connection(connection)
+
+    @backoff(logy=log.getChild('PGStorage.retrieve_state'))
+    def retrieve_state(self) -> dict:
+        connection = get_pg_connection()
+        try:
+            with connection, connection.cursor() as cursor:
+                cursor.execute(
+                    f'SELECT key, value FROM {app_config.state_table} WHERE namespace = %s', (self.namespace,)
+                )
+                return dict(cursor.fetchall())
+        finally:
+            release_pg_connection(connection)
+
+
+def get_storage(file_path=app_config.storage_file_path) -> BaseStorage:
+    """Хранилище состояния, выбранное в app_config.state_backend.
+    Для БД бэкендов имя json файла задаёт пространство ключей
+    """
+    if app_config.state_backend == 'postgres':
+        return PGStorage(file_path)
+    if app_config.state_backend == 'sqlite':
+        return SQLiteStorage(file_path)
+    return JsonFileStorage(file_path)
+
+
+class _StateCache:
+    """Общий для всех State одного хранилища кеш состояния и счётчики политики сброса"""
+
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+        self.data = storage.retrieve_state()
+        self.dirty = 0
+        # Ключи, изменённые после последнего сброса
+        self.changed = set()
+        self.flushed_at = time.monotonic()
+
+    def flush(self) -> None:
+        if not self.changed:
+            # Общее хранилище перечитывается и без изменений: контрольные точки других реплик
+            if self.storage.shared:
+                self.data = self.storage.retrieve_state()
+            return
+        fresh = self.storage.save_state(self.data, self.changed)
+        if fresh is not None:
+            self.data = fresh
+        self.dirty = 0
+        self.changed = set()
+        self.flushed_at = time.monotonic()
+
+
+_caches: Dict[str, _StateCache] = {}
+
 
 class State:
     """
     Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
-    Здесь представлена реализация с сохранением состояния в файл.
-    В целом ничего не мешает поменять это поведение на работу с БД или распределённым хранилищем.
+    Состояние держится в памяти процесса (кеш общий для всех State одного хранилища)
+    и сбрасывается в хранилище согласно app_config.state_flush_policy:
+        always - на каждую запись,
+        every_n - каждые state_flush_every записей,
+        timer - не чаще, чем раз в state_flush_interval секунд.
+    Хранилище выбирается в app_config.state_backend (см. get_storage): json файл, SQLite или таблица Postgres.
     """
 
-    def __init__(self, storage: JsonFileStorage):
+    def __init__(self, storage: BaseStorage):
         self.storage = storage
+        self.cache = _caches.get(storage.key)
+        if self.cache is None:
+            self.cache = _StateCache(storage)
+            _caches[storage.key] = self.cache
 
     def set_state(self, key: str, value: Any, ) -> None:
-        self.storage.save_state({key: value})
+        # Значение проходит через JSON, чтобы из кеша читалось то же, что и из хранилища
+        self.cache.data[key] = json.loads(json.dumps(value, default=str))
+        self.cache.dirty += 1
+        self.cache.changed.add(key)
+        if self._need_flush():
+            self.flush()
 
     def get_state(self, key: str) -> Any:
-        res = self.storage.retrieve_state()
-        return res.get(key)
+        return self.cache.data.get(key)
+
+    def flush(self) -> None:
+        self.cache.flush()
+
+    def _need_flush(self) -> bool:
+        policy = app_config.state_flush_policy
+        if policy == 'every_n':
+            return self.cache.dirty >= app_config.state_flush_every
+        if policy == 'timer':
+            return time.monotonic() - self.cache.flushed_at >= app_config.state_flush_interval
+        return True
+
+
+@atexit.register
+def flush_states() -> None:
+    """Сбросить в хранилища все несохранённые состояния"""
+    for cache in _caches.values():
+        cache.flush()
 
 
 if __name__ == '__main__':
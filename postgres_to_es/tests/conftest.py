@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Модули ETL импортируются так же, как при запуске из папки postgres_to_es,
+# config читает settings/config.toml относительно неё
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+# logger пишет в logs/debug.log (log_file_path), папки может не быть в свежем клоне
+os.makedirs('logs', exist_ok=True)
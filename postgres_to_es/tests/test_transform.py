@@ -0,0 +1,65 @@
+import random
+import uuid
+from datetime import datetime as dt, timedelta, timezone
+
+import pytest
+
+from transform import batch_transformer, transformer
+
+ROLES = ('actor', 'writer', 'director')
+
+
+def make_uuid(rng: random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def film_rows(rng: random.Random, persons: list, genres: list) -> list:
+    """Строки sql_get_film одного фильма: все сочетания его ролей и жанров, как у LEFT JOIN.
+    Фильм без ролей даёт строки с пустыми role и персоной
+    """
+    film_id = make_uuid(rng)
+    title = f'Film {rng.randint(0, 10 ** 6)}'
+    rating = round(rng.uniform(1, 10), 1)
+    updated_at = None if rng.random() < 0.1 else dt(2021, 1, 1, tzinfo=timezone.utc) + timedelta(
+        seconds=rng.randint(0, 10 ** 7)
+    )
+    roles = [(rng.choice(ROLES), *rng.choice(persons)) for _ in range(rng.randint(0, 6))] or [(None, None, None)]
+    film_genres = rng.sample(genres, rng.randint(1, 3))
+    return [
+        (film_id, title, f'Description of {title}', rating, role, person_id, person_name, genre_name, genre_id,
+         updated_at)
+        for role, person_id, person_name in roles
+        for genre_id, genre_name in film_genres
+    ]
+
+
+def catalogue(seed: int) -> tuple:
+    """Фильмы (строки каждого) и перемешанный плоский список строк всех фильмов, как у sql_get_films"""
+    rng = random.Random(seed)
+    persons = [(make_uuid(rng), f'Person {rng.randint(0, 50)}') for _ in range(40)]
+    genres = [(make_uuid(rng), f'Genre {number}') for number in range(8)]
+    films = [film_rows(rng, persons, genres) for _ in range(rng.randint(1, 30))]
+    rows = [row for film in films for row in film]
+    rng.shuffle(rows)
+    return films, rows
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_batch_transformer_matches_transformer(seed):
+    films, rows = catalogue(seed)
+    rng = random.Random(seed)
+    expected = dict(
+        (film_id, doc) for doc, film_id in (transformer(rng.sample(film, len(film))) for film in films)
+    )
+
+    result = batch_transformer(rows)
+
+    assert len(result) == len(films)
+    assert {film_id: doc for doc, film_id in result} == expected
+
+
+def test_batch_transformer_keeps_first_appearance_order():
+    _, rows = catalogue(0)
+    first_seen = list(dict.fromkeys(row[0] for row in rows))
+
+    assert [film_id for _, film_id in batch_transformer(rows)] == first_seen
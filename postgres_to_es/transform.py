@@ -1,13 +1,14 @@
 from data_classes import MovieRaw, GenreRaw, PersonRaw
+from profiling import traced
 
 
 def _person_formatter(persons: dict) -> list:
-    output = [{'uuid': k, 'full_name': v} for k, v in persons.items()]
+    output = [{'uuid': k, 'full_name': v} for k, v in sorted(persons.items())]
     return output
 
 
 def _genre_formatter(genres: dict) -> list:
-    output = [{'uuid': k, 'name': v} for k, v in genres.items()]
+    output = [{'uuid': k, 'name': v} for k, v in sorted(genres.items())]
     return output
 
 
@@ -31,6 +32,7 @@ def person_transformer(person_to_transform):
     return doc, data.uuid
 
 
+@traced('transform')
 def transformer(movie_to_transform: list) -> tuple:
     """
     Принимает список списков денормализованных данных по одному фильму
@@ -53,7 +55,7 @@ def transformer(movie_to_transform: list) -> tuple:
         genres[data.genre_id] = data.genre
         if data.role == 'director':
             director.add(data.person_name)
-            directors[data.person_id] = data.person_id
+            directors[data.person_id] = data.person_name
         elif data.role == 'writer':
             writer_names.add(data.person_name)
             writers[data.person_id] = data.person_name
@@ -61,17 +63,31 @@ def transformer(movie_to_transform: list) -> tuple:
             actor_names.add(data.person_name)
             actors[data.person_id] = data.person_name
 
-    director = None if not director else ', '.join(director)
-    genre = None if not genre else ', '.join(genre)
-    actor_names = None if not actor_names else ', '.join(actor_names)
-    writer_names = None if not writer_names else list(writer_names)
+    return _movie_doc(
+        data.uuid, data.title, data.description, data.imdb_rating, data.updated_at,
+        director, genre, actor_names, writer_names, actors, writers, directors, genres
+    )
+
+
+def _movie_doc(
+        uuid, title, description, imdb_rating, updated_at,
+        director: set, genre: set, actor_names: set, writer_names: set,
+        actors: dict, writers: dict, directors: dict, genres: dict
+) -> tuple:
+    """Собрать doc фильма для ES из накопленных по его строкам множеств и словарей"""
+    # Порядок не зависит от порядка строк и хеширования строк, одинаковые данные дают одинаковый doc
+    director = None if not director else ', '.join(sorted(director))
+    genre = None if not genre else ', '.join(sorted(genre))
+    actor_names = None if not actor_names else ', '.join(sorted(actor_names))
+    writer_names = None if not writer_names else sorted(writer_names)
 
     doc = {
-        'id': data.uuid,
-        'imdb_rating': data.imdb_rating,
+        'id': uuid,
+        'imdb_rating': imdb_rating,
+        'updated_at': None if updated_at is None else updated_at.isoformat(),
         'genre': _genre_formatter(genres),
-        'title': data.title,
-        'description': data.description,
+        'title': title,
+        'description': description,
         'director': director,
         'actors_names': actor_names,
         'writers_names': writer_names,
@@ -80,7 +96,36 @@ def transformer(movie_to_transform: list) -> tuple:
         'directors': _person_formatter(directors)
 
     }
-    return doc, data.uuid
+    return doc, uuid
+
+
+@traced('transform.batch')
+def batch_transformer(rows: list) -> list:
+    """
+    Принимает плоский список строк денормализованных данных по многим фильмам (sql_get_films),
+    за один проход без создания объектов на каждую строку группирует их по uuid фильма
+    и отдаёт список (doc, uuid) для ES в порядке первого появления фильма.
+    doc каждого фильма совпадает с результатом transformer по его строкам
+    """
+    films = {}
+    for fw_id, title, description, rating, role, person_id, person_name, genre_name, genre_id, updated_at in rows:
+        film = films.get(fw_id)
+        if film is None:
+            film = films[fw_id] = [title, description, rating, updated_at, set(), set(), set(), set(), {}, {}, {}, {}]
+        _, _, _, _, director, genre, actor_names, writer_names, actors, writers, directors, genres = film
+        genre.add(genre_name)
+        genres[genre_id] = genre_name
+        if role == 'director':
+            director.add(person_name)
+            directors[person_id] = person_name
+        elif role == 'writer':
+            writer_names.add(person_name)
+            writers[person_id] = person_name
+        elif role == 'actor':
+            actor_names.add(person_name)
+            actors[person_id] = person_name
+
+    return [_movie_doc(fw_id, *film) for fw_id, film in films.items()]
 
 
 if __name__ == '__main__':
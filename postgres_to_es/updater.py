@@ -1,52 +1,176 @@
 import time
 
-from config import es_config, app_config, movies_index, genre_index, person_index
+from change_feed import ChangeListener
+from config import app_config, pg_config, movies_index, genre_index, person_index
 from connectors import ESConnector, PGConnector
+import metrics
+import profiling
 from logger import log
-from side_updater import side_check
-from transform import transformer
+from scheduler import PollScheduler
+from side_updater import side_check, side_checkpoint
+from storage import flush_states
+from transform import batch_transformer, transformer
 
 log = log.getChild(__name__)
 
 
 def updater(pg, es):
     for data in pg.pop_next_to_update():
-        es.add_to_block(*transformer(data))
-        if len(es.block) >= es_config.bulk_factor:
-            es.last_time = pg.last_time
+        with metrics.timed('transform'):
+            doc, uuid = transformer(data)
+        metrics.DOCS_TRANSFORMED.inc()
+        es.add_to_block(doc, uuid)
+        if es.is_block_full():
             es.load()
-    es.last_time = pg.last_time
     es.load()
+    es.wait_all()
+
+
+def batch_updater(pg, es):
+    """Как updater, но строки целой пачки фильмов трансформируются за один проход batch_transformer"""
+    for chunk, rows in pg.pop_next_batch():
+        with metrics.timed('transform'):
+            docs = {uuid: doc for doc, uuid in batch_transformer(rows)}
+        metrics.DOCS_TRANSFORMED.inc(len(docs))
+        for ids, updated_at in chunk:
+            if ids not in docs:
+                continue
+            es.add_to_block(docs.pop(ids), ids)
+            if es.is_block_full():
+                es.load()
+    es.load()
+    es.wait_all()
+
+
+def update(pg, es):
+    """Проход очереди pg: batch_updater, если включены batch_extract и batch_transform, иначе updater"""
+    if pg_config.batch_extract and app_config.batch_transform:
+        batch_updater(pg=pg, es=es)
+    else:
+        updater(pg=pg, es=es)
+
+
+def partial_update(source: str, pg, es) -> int:
+    """Переименования персон (p) или жанров (g) частичным обновлением документов фильмов в ES,
+    отдаёт число изменённых строк источника
+    """
+    rows = pg.get_changed_persons() if source == 'p' else pg.get_changed_genres()
+    if not rows:
+        return 0
+    names = {str(row[0]): row[2] for row in rows}
+    if es.fingerprints is not None:
+        es.fingerprints.forget_ids(es.index, pg.get_films_of(source, list(names)))
+    if source == 'p':
+        es.rename_persons(names)
+    else:
+        es.rename_genres(names)
+    pg.commit_checkpoint(source, rows)
+    return len(rows)
+
+
+def propagate_deletions(pg, es) -> int:
+    """Удалить из ES документы по странице записей об удалённых строках Postgres и поместить в очередь pg
+    фильмы, у которых удалены связи с персонами или жанрами. Отдаёт число записей об удалении
+    """
+    tombstones = pg.get_tombstones()
+    deleted = {movies_index: [], genre_index: [], person_index: []}
+    films = {}
+    for _, _, table, row_id, film_work_id in tombstones:
+        if table == 'film_work':
+            deleted[movies_index].append(row_id)
+        elif table == 'person':
+            deleted[person_index].append(row_id)
+        elif table == 'genre':
+            deleted[genre_index].append(row_id)
+        else:
+            films[film_work_id] = None
+    for index, ids in deleted.items():
+        if ids:
+            es.delete_documents(index, ids)
+    for film_id in deleted[movies_index]:
+        films.pop(film_id, None)
+    pg.push_films(list(films))
+    return len(tombstones)
+
+
+def poll_source(source: str, pg, es) -> int:
+    """Опросить источник, отдаёт число новых строк источника.
+    Затронутые фильмы попадают в очередь цикла pg, индекс жанров, персон и частичные обновления пишутся сразу
+    """
+    if source == 'side':
+        return side_check()
+    if source == 'del':
+        return propagate_deletions(pg, es)
+    if source in ('p', 'g') and app_config.partial_updates:
+        return partial_update(source, pg, es)
+    if source == 'fw':
+        return pg.get_films_ids()
+    if source == 'p':
+        return pg.check_persons_updates()
+    return pg.check_genres_updates()
+
+
+def source_checkpoint(source: str, pg):
+    """updated_at контрольной точки источника"""
+    return side_checkpoint() if source == 'side' else pg.state.get_state(source)
+
+
+def poll_sources() -> tuple:
+    """Источники, которые опрашивает цикл обновления"""
+    return ('fw', 'p', 'g', 'side', 'del') if app_config.deletions else ('fw', 'p', 'g', 'side')
+
+
+def is_full(source: str, rows: int) -> bool:
+    """Полная ли пачка вернулась: значит, изменений, скорее всего, больше"""
+    return source != 'side' and rows >= pg_config.bulk_factor
 
 
 def never_ending_process():
     es = ESConnector()
     pg = PGConnector()
-    indexes_files = {
-        movies_index: es_config.default_scheme_file,
-        genre_index: es_config.genres_scheme_file,
-        person_index: es_config.persons_scheme_file,
-    }
+    es.prepare_indexes()
+    if app_config.deletions:
+        pg.prepare_tombstones()
+    if app_config.change_feed:
+        pg.prepare_change_feed()
+    listener = ChangeListener() if app_config.change_feed else None
+    metrics.start()
+    profiling.install()
 
-    for index, file in indexes_files.items():
-        if not es.is_index_exist(index):
-            result = es.create_indexes(index, file)
-            log.info(f'created index: {result}')
+    scheduler = PollScheduler(poll_sources())
 
     while True:
-        while pg.is_not_complete():
-            pg.get_films_ids()
-            updater(pg=pg, es=es)
-            pg.check_persons_updates()
-            updater(pg=pg, es=es)
-            pg.check_genres_updates()
-            updater(pg=pg, es=es)
-            side_check()
+        with profiling.cycle():
+            polled = [(source, poll_source(source, pg, es)) for source in scheduler.due()]
+            if polled:
+                # Каждый фильм, найденный любым из источников, извлекается и индексируется один раз за цикл
+                update(pg=pg, es=es)
+                pg.commit_queue()
+        for source, rows in polled:
+            scheduler.record(source, rows, is_full(source, rows), source_checkpoint(source, pg))
 
-        log.info(f'Nothing to update, now wait for {app_config.await_time} sec ...')
-        time.sleep(app_config.await_time)
-        pg.not_complete = {'fw': True, 'p': True, 'g': True}
+        wait = scheduler.next_wait()
+        if not wait:
+            continue
+        flush_states()
+        metrics.export()
+        scheduler.log_stats()
+        log.info(f'Nothing to update, now wait for {wait:.1f} sec ...')
+        if listener is not None:
+            tables = listener.wait(wait)
+            if tables:
+                log.info(f'Changes notified in: {", ".join(sorted(tables))}')
+                scheduler.wake(tables)
+        else:
+            time.sleep(wait)
 
 
 if __name__ == '__main__':
-    never_ending_process()
+    if app_config.async_pipeline:
+        import asyncio
+
+        from async_updater import async_never_ending_process
+
+        asyncio.run(async_never_ending_process())
+    else:
+        never_ending_process()